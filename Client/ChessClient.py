@@ -54,6 +54,12 @@ class ChessApp:
         print(f"[Info]: Waiting for console to connect at {self.__console_listener.getsockname()}")
 
         self.__server_to_client_sock : socket.socket|None = None
+        self.__server_caps : set[str] = set()
+        self.__server_decoder : protocol.FrameDecoder = protocol.FrameDecoder()
+        self.__next_request_id : int = 0
+        # token of the last session, kept across connections to resume it without logging in
+        self.__session_token : str|None = None
+        self.__pending_requests : dict[int, str] = dict()
 
         self.__sel : selectors.DefaultSelector|None = selectors.DefaultSelector()
         self.__sel.register(self.__console_listener, selectors.EVENT_READ, data=CONSOLE_LISTENER)
@@ -62,6 +68,8 @@ class ChessApp:
         self.__in_game : bool = False
         self.__selected_square = None
         self.__current_gameboard : chess.Board = chess.Board(chess.STARTING_FEN)
+        # board of active game as last confirmed by server, current one may contain move voted on
+        self.__synced_gameboard : chess.Board|None = None
         self.__current_color = WHITE
         self.__current_perspective = WHITE
 
@@ -87,28 +95,20 @@ class ChessApp:
                     if(msg := protocol.recv_msg(self.__console_to_client_sock)) is not None:
                         print("[CONSOLE]>>", msg)
                         if self.__is_connected():
-                            if (successfully_sent := protocol.send_msg(self.__server_to_client_sock, msg)):
-                                if (byte := protocol.recv_byte(self.__server_to_client_sock)) is not None:
-                                    self.__handle_sent_msg(msg, byte == protocol.FAILURE_BYTE)
-                                else:
-                                    print("[Error]: Couldn't receive confirmation byte")
-                                    self.__disconnect_from_server()
-
-                            pass
+                            self.__request(self.__conditional_refresh(msg))
                         else:
                             self.__handle_console_msg(msg)
                     else:
                         self.__disconnect_console()
 
                 elif sock_type == SERVER_TO_CLIENT:
-                    if(msg := protocol.recv_msg(self.__server_to_client_sock)) is not None:
-                        if(msg.startswith(protocol.FEN_PREFIX)):
-                            fen = msg[len(protocol.FEN_PREFIX):]
-                            self.__current_gameboard = chess.Board(fen)
-                            print(msg)
-                            print(f"[Info]: This game ID: {self.__active_game_id}")
-                        else:
-                            print(msg)
+                    if protocol.recv_into(self.__server_to_client_sock, self.__server_decoder):
+                        try:
+                            for msg in self.__server_decoder:
+                                self.__handle_server_msg(msg)
+                        except ValueError as e:
+                            print(f"[Error]: Malformed frame from server: {e}")
+                            self.__disconnect_from_server()
                     else:
                         print("[Error]: Couldn't receive message from server")
                         self.__disconnect_from_server()
@@ -132,6 +132,64 @@ class ChessApp:
             pygame.display.update()
 
 
+    def __handle_server_msg(self, msg : str):
+        if (update := protocol.parse_update(msg)) is not None:
+            game_id, seq, move, fen = update
+            if game_id == self.__active_game_id:
+                if self.__synced_gameboard is not None and self.__synced_gameboard.ply() + 1 == seq:
+                    self.__synced_gameboard.push_uci(move)
+                    self.__set_synced_board(self.__synced_gameboard)
+                else:
+                    self.__set_synced_board(chess.Board(fen))
+                print(f"[Info]: Move {move} made in game {game_id}")
+        elif (token := protocol.parse_session(msg)) is not None:
+            self.__session_token = token
+            print("[Info]: Session can be resumed after reconnecting")
+        elif (delta := protocol.parse_delta(msg)) is not None:
+            seq, moves = delta
+            if self.__synced_gameboard is not None and self.__synced_gameboard.ply() + len(moves) == seq:
+                for move in moves:
+                    self.__synced_gameboard.push_uci(move)
+                self.__set_synced_board(self.__synced_gameboard)
+                print(f"[Info]: Game {self.__active_game_id} is up to date, {len(moves)} new moves")
+            elif self.__active_game_id is not None and protocol.CAP_TAGGED in self.__server_caps:
+                # board went out of sync in the meantime, ask for the whole position
+                self.__request(f"rf {self.__active_game_id}")
+        elif (reply := protocol.parse_reply(msg)) is not None:
+            request_id, ok, payload = reply
+            sent_msg = self.__pending_requests.pop(request_id, None)
+            if sent_msg is not None and ok and payload is not None and sent_msg.split()[0] == protocol.BATCH_MSG:
+                # every command of batch is handled as if it was answered on its own
+                for cmd, (cmd_ok, cmd_payload) in zip(protocol.split_batch(sent_msg), protocol.parse_batch_reply(payload)):
+                    self.__handle_sent_msg(cmd, not cmd_ok)
+                    if cmd_payload is not None:
+                        self.__handle_server_msg(cmd_payload)
+                return
+            if sent_msg is not None:
+                self.__handle_sent_msg(sent_msg, not ok)
+            if payload is not None:
+                self.__handle_server_msg(payload)
+        elif(msg.startswith(protocol.FEN_PREFIX)):
+            fen = msg[len(protocol.FEN_PREFIX):]
+            self.__set_synced_board(chess.Board(fen))
+            print(msg)
+            print(f"[Info]: This game ID: {self.__active_game_id}")
+        else:
+            print(msg)
+
+    def __set_synced_board(self, board : chess.Board):
+        self.__synced_gameboard = board
+        self.__current_gameboard = board.copy()
+
+    def __conditional_refresh(self, msg : str) -> str:
+        """rewrites 'rf <active game>' to ask only for moves made since the last synced position, also inside batch"""
+        match msg.split():
+            case [protocol.BATCH_MSG, *_]:
+                return protocol.make_batch([self.__conditional_refresh(cmd) for cmd in protocol.split_batch(msg)])
+            case ["rf", game_id] if self.__synced_gameboard is not None and utility.silent_convert((game_id, int)) == [self.__active_game_id]:
+                return f"rf {self.__active_game_id} {self.__synced_gameboard.ply()}"
+        return msg
+
     # drawing routines
 
     def __draw_board(self):
@@ -223,13 +281,7 @@ class ChessApp:
                 move = chess.square_name(chess.square(*self.__selected_square)) + chess.square_name(chess.square(new_f,new_r))
 
                 if self.__is_connected() and self.__active_game_id is not None:
-                    msg = f"vote {self.__active_game_id} {move}"
-                    if (successfully_sent := protocol.send_msg(self.__server_to_client_sock, msg)):
-                        if (byte := protocol.recv_byte(self.__server_to_client_sock)) is not None:
-                            if byte == protocol.FAILURE_BYTE:
-                                self.__disconnect_from_server()
-                            else:
-                                self.__current_gameboard.push_uci(move)
+                    self.__request(f"vote {self.__active_game_id} {move}")
                 else:
                     self.__current_gameboard.push_uci(move)
 
@@ -304,6 +356,13 @@ class ChessApp:
                 if (args := utility.silent_convert((client_id, int))) is not None:
                     self.__id, *_ = args
                     print(f"[Server]: Client ID: {self.__id}")
+                    self.__negotiate_capabilities()
+                    self.__server_decoder = protocol.FrameDecoder(protocol.framing_for(self.__server_caps))
+                    if self.__session_token is not None and protocol.CAP_SESSION in self.__server_caps:
+                        self.__request(f"{protocol.RESUME_MSG} {self.__session_token}")
+                elif client_id == protocol.SERVER_FULL_MSG:
+                    print("[Error]: Server is full, try again later")
+                    self.__disconnect_from_server()
                 else:
                     print("[Error]: Wrong type of client ID")
                     self.__disconnect_from_server()
@@ -314,7 +373,48 @@ class ChessApp:
             self.__server_to_client_sock.close()
             self.__server_to_client_sock = None
 
-        self.__sel.register(self.__server_to_client_sock, selectors.EVENT_READ, data=SERVER_TO_CLIENT)
+        if self.__is_connected():
+            self.__sel.register(self.__server_to_client_sock, selectors.EVENT_READ, data=SERVER_TO_CLIENT)
+
+    def __negotiate_capabilities(self):
+        self.__server_caps = set()
+        if not protocol.send_msg(self.__server_to_client_sock, " ".join([protocol.HELLO_MSG, *protocol.CAPABILITIES])):
+            return
+        # servers unaware of the handshake answer with bare confirmation byte
+        if protocol.recv_byte(self.__server_to_client_sock) != protocol.SERVER_ID:
+            print("[Info]: Server does not support capabilities, using legacy protocol")
+            return
+        if (answer := protocol.recv_msg(self.__server_to_client_sock)) is not None:
+            match answer.split():
+                case [protocol.HELLO_MSG, *accepted]:
+                    self.__server_caps = set(accepted) & set(protocol.CAPABILITIES)
+                    print(f"[Info]: Server capabilities: {sorted(self.__server_caps)}")
+
+    def __request(self, msg : str) -> bool:
+        """
+        Sends command to server, reply to tagged request is handled whenever it arrives,
+        otherwise waits for confirmation byte;
+        returns False if command couldn't be sent
+        """
+        if protocol.CAP_TAGGED in self.__server_caps:
+            request_id = self.__next_request_id
+            self.__next_request_id += 1
+            if not self.__send_to_server(protocol.tag_msg(request_id, msg)):
+                return False
+            self.__pending_requests[request_id] = msg
+            return True
+
+        if not self.__send_to_server(msg):
+            return False
+        if (byte := protocol.recv_byte(self.__server_to_client_sock)) is None:
+            print("[Error]: Couldn't receive confirmation byte")
+            self.__disconnect_from_server()
+            return False
+        self.__handle_sent_msg(msg, byte == protocol.FAILURE_BYTE)
+        return True
+
+    def __send_to_server(self, msg : str) -> bool:
+        return protocol.send_msg(self.__server_to_client_sock, msg, framing=protocol.framing_for(self.__server_caps))
 
     def __is_connected(self):
         return self.__server_to_client_sock is not None
@@ -323,6 +423,8 @@ class ChessApp:
         if self.__is_connected():
             self.__safe_unregister_and_close(self.__server_to_client_sock)
             self.__server_to_client_sock = None
+            self.__server_caps = set()
+            self.__pending_requests = dict()
             print("[Info]: Disconnected from server")
         else:
             print("[Error]: Client is not connected to server")
@@ -333,6 +435,9 @@ class ChessApp:
                 self.__disconnect_from_server()
             case [protocol.CONSOLE_DSC_MSG]:
                 self.__disconnect_console()
+            case [protocol.RESUME_MSG, token]:
+                if failure:
+                    self.__session_token = None
             case ["register", login, password]:
                 pass
             case ["login", login, password]:
@@ -347,7 +452,8 @@ class ChessApp:
                     print(f"joined game with id {self.__active_game_id}")
             
             case ["vote", game_id, move]:
-                pass
+                if utility.silent_convert((game_id, int)) == [self.__active_game_id] and not failure:
+                    utility.silent_apply(move, self.__current_gameboard.push_uci)
 
             case ["analyze", game_id]:
                 pass
@@ -0,0 +1,217 @@
+import os
+import sys
+import inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import asyncio
+import concurrent.futures
+import time
+import protocol
+from collections import Counter
+from games_manager import GameManager
+from account_manager import AccountManager
+from commands import CommandHandler
+from subscriptions import SubscriptionRegistry
+
+# threads running account commands, they read files and hash passwords
+ACCOUNT_WORKERS = 4
+
+
+class AsyncServer:
+    """
+    asyncio based server with the same command set as Server,
+    every client is served by its own coroutine and games are processed by a scheduled task,
+    so waiting on one client never stops the others
+    """
+    def __init__(self, host : str, port : int):
+        self.__host : str = host
+        self.__port : int = port
+        self.__server : asyncio.Server|None = None
+        self.__process_task : asyncio.Task|None = None
+        self.__schedule_changed : asyncio.Event = asyncio.Event()
+        self.__deadline : float|None = None
+
+        self.__clients_writers : dict[int, asyncio.StreamWriter] = dict()
+        self.__clients_caps : dict[int, set[str]] = dict()
+        self.__clients_counter : int = 0
+        self.__overflow_counters : Counter = Counter()
+
+        self.__games_manager = GameManager()
+        self.__commands = CommandHandler(self.__games_manager)
+        self.__subscriptions = SubscriptionRegistry()
+        self.__games_manager.add_move_listener(self.__push_move)
+        self.__account_executor = concurrent.futures.ThreadPoolExecutor(ACCOUNT_WORKERS)
+        # login -> (lock, number of commands holding or waiting for it), commands on one account run in order
+        self.__account_locks : dict[str, tuple[asyncio.Lock, int]] = dict()
+
+    async def run(self):
+        self.__server = await asyncio.start_server(self.__handle_client, self.__host, self.__port)
+        print(f"[Info]: Listening for clients at {self.__server.sockets[0].getsockname()}")
+        self.__process_task = asyncio.create_task(self.__process_games())
+        try:
+            async with self.__server:
+                await self.__server.serve_forever()
+        finally:
+            self.close_server()
+
+    def close_server(self):
+        if self.__server is not None:
+            print("[Info]: Closing server")
+            if self.__process_task is not None:
+                self.__process_task.cancel()
+                self.__process_task = None
+            for writer in list(self.__clients_writers.values()):
+                writer.close()
+            self.__server.close()
+            self.__server = None
+            self.__account_executor.shutdown(wait=False)
+            print("[Info]: Server closed")
+
+    async def __process_games(self):
+        """Sleeps until the next game is due or schedule changes, then processes due games"""
+        while True:
+            try:
+                if (res := self.__games_manager.process_all()):
+                    print(res)
+            except Exception as e:
+                print(f"[Exception] __process_games(): {e}")
+
+            self.__deadline = self.__games_manager.next_deadline()
+            self.__schedule_changed.clear()
+            timeout = None if self.__deadline is None else max(0.0, self.__deadline - time.time())
+            if timeout == 0:
+                # backlog is left, let clients be served before the next batch
+                await asyncio.sleep(0)
+                continue
+            try:
+                await asyncio.wait_for(self.__schedule_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def __check_schedule(self):
+        """Wakes processing task if a command has moved the next deadline"""
+        if self.__games_manager.next_deadline() != self.__deadline:
+            self.__schedule_changed.set()
+
+    def __push_move(self, game_id : int, seq : int, move : str, fen : str):
+        """
+        Writes update to every subscribed client, encoded once per framing,
+        transport buffers can't be coalesced, so updates are dropped for clients
+        with more than OUTBOUND_MAX_SIZE bytes still unsent
+        """
+        msg = protocol.make_update(game_id, seq, move, fen)
+        frames = dict()
+        for id in self.__subscriptions.subscribers(game_id):
+            framing = protocol.framing_for(self.__clients_caps[id])
+            if framing not in frames:
+                frames[framing] = protocol.encode_frame(msg, framing)
+            writer = self.__clients_writers[id]
+            if writer.transport.get_write_buffer_size() > protocol.OUTBOUND_MAX_SIZE:
+                self.__overflow_counters[protocol.OVERFLOW_DROP] += 1
+                continue
+            writer.writelines(frames[framing])
+
+    async def __execute_blocking(self, am : AccountManager, msg : str):
+        """
+        Runs account command on executor, so the loop goes on serving other clients,
+        commands on one login run in order, so two registrations can't both pass the exists check
+        """
+        loop = asyncio.get_running_loop()
+        args = msg.split()
+        if len(args) < 2:
+            return await loop.run_in_executor(self.__account_executor, self.__commands.execute, am, msg)
+        login = args[1]
+        lock, users = self.__account_locks.get(login, (asyncio.Lock(), 0))
+        self.__account_locks[login] = (lock, users + 1)
+        try:
+            async with lock:
+                return await loop.run_in_executor(self.__account_executor, self.__commands.execute, am, msg)
+        finally:
+            lock, users = self.__account_locks[login]
+            if users == 1:
+                del self.__account_locks[login]
+            else:
+                self.__account_locks[login] = (lock, users - 1)
+
+    def __get_unique_client_id(self) -> int:
+        id = self.__clients_counter
+        self.__clients_counter += 1
+        return id
+
+    async def __handle_client(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        client_id = self.__get_unique_client_id()
+        am = AccountManager()
+        caps : set[str] = set()
+        self.__clients_writers[client_id] = writer
+        self.__clients_caps[client_id] = caps
+        print(f"[Info]: Accepted new client, addr: {writer.get_extra_info('peername')}, ID: {client_id}")
+
+        try:
+            if not await protocol.async_send_msg(writer, f"{client_id}"):
+                return
+            while (msg := await protocol.async_recv_msg(reader, framing=protocol.framing_for(caps))) is not None:
+                request_id, msg = protocol.untag_msg(msg)
+                # votes aren't echoed, same as in Server
+                if msg.partition(" ")[0] != "vote":
+                    usr_name = client_id if not am.logged_in else am.login
+                    print(f"[{usr_name}]: {msg}")
+                match msg.split():
+                    case [protocol.HELLO_MSG, *capabilities]:
+                        # sessions are not kept by this server
+                        accepted = protocol.accept_capabilities(capabilities, [cap for cap in protocol.CAPABILITIES if cap != protocol.CAP_SESSION])
+                        await protocol.async_send_byte(writer, protocol.SERVER_ID)
+                        # answer is sent in current framing, negotiated one applies to messages after it
+                        await protocol.async_send_msg(writer, " ".join([protocol.HELLO_MSG, *accepted]), framing=protocol.framing_for(caps))
+                        self.__clients_caps[client_id] = caps = set(accepted)
+
+                    case [protocol.CLIENT_DSC_MSG]:
+                        await self.__send_reply(writer, caps, request_id, True)
+                        break
+
+                    case _:
+                        if msg.partition(" ")[0] in ("register", "login"):
+                            reply = await self.__execute_blocking(am, msg)
+                        else:
+                            reply = self.__commands.execute(am, msg)
+                        self.__check_schedule()
+                        if protocol.CAP_PUSH in caps and protocol.CAP_TAGGED in caps and am.logged_in:
+                            self.__subscriptions.sync(client_id, am.games.keys())
+                        if not await self.__send_reply(writer, caps, request_id, *reply):
+                            print("[Error]: Couldn't send reply to client", client_id)
+                            break
+        finally:
+            del self.__clients_writers[client_id]
+            del self.__clients_caps[client_id]
+            self.__subscriptions.remove(client_id)
+            writer.close()
+            print(f"[Info]: Client with ID {client_id} just disconnected")
+
+    async def __send_reply(self, writer : asyncio.StreamWriter, caps : set[str], request_id : int|None, ok : bool, msg : str|None = None) -> bool:
+        """Same encoding of replies as Server.__send_reply"""
+        framing = protocol.framing_for(caps)
+        if request_id is not None:
+            return await protocol.async_send_msg(writer, protocol.make_reply(request_id, ok, msg), framing=framing)
+        if not await protocol.async_send_byte(writer, protocol.CONFIRMATION_BYTE if ok else protocol.FAILURE_BYTE):
+            return False
+        if msg is not None:
+            return await protocol.async_send_msg(writer, msg, framing=framing)
+        return True
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <clients_port> \n e.g. {sys.argv[0]} 5050")
+        sys.exit(1)
+
+    server = AsyncServer("127.0.0.1", int(sys.argv[1]))
+
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        print("\nCaught keyboard interrupt, exiting")
+    except Exception as e:
+        print("\n[Exception]:", e)
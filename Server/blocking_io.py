@@ -0,0 +1,102 @@
+import queue
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BlockingIO:
+    """
+    Bounded pool of threads for blocking file I/O and password hashing,
+    results are handed back to the server loop, which is woken up through a socketpair
+    registered in its selector, so callbacks always run on the loop thread, from dispatch
+    """
+    def __init__(self, workers : int = 4, max_pending : int = 256):
+        self.__executor = ThreadPoolExecutor(workers, thread_name_prefix="blocking_io")
+        self.__max_pending : int = max_pending
+        self.__pending : int = 0  # tasks submitted and not dispatched yet, touched by loop thread only
+        self.__completed : queue.SimpleQueue = queue.SimpleQueue()
+        self.__chains : dict = dict()  # key -> event set when the last task with that key has finished
+        self.__wakeup_recv, self.__wakeup_send = socket.socketpair()
+        self.__wakeup_recv.setblocking(False)
+        self.__wakeup_send.setblocking(False)
+
+    def wakeup_socket(self) -> socket.socket:
+        """becomes readable when there are completions to dispatch"""
+        return self.__wakeup_recv
+
+    def pending(self) -> int:
+        return self.__pending
+
+    def submit(self, fn, *args, callback = None, key = None):
+        """
+        Runs fn(*args) on the pool, then callback(result, exception) on the loop thread;
+        tasks with the same key, e.g. writes of one file, run in order of submission;
+        with max_pending tasks in flight fn runs inline, so the loop slows down instead of queueing without bound,
+        after the tasks with the same key that are still queued
+        """
+        if self.__pending >= self.__max_pending:
+            if key is not None and (previous := self.__chains.get(key)) is not None:
+                previous.wait()
+            result, error = self.__call(fn, args)
+            self.__finish(callback, result, error)
+            return
+        self.__pending += 1
+        previous = self.__chains.get(key) if key is not None else None
+        done = threading.Event()
+        if key is not None:
+            self.__chains[key] = done
+        self.__executor.submit(self.__run, fn, args, callback, key, previous, done)
+
+    def dispatch(self):
+        """Runs callbacks of completed tasks, to be called when wakeup socket is readable"""
+        try:
+            while self.__wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                callback, result, error, key, done = self.__completed.get_nowait()
+            except queue.Empty:
+                break
+            self.__pending -= 1
+            if key is not None and self.__chains.get(key) is done:
+                del self.__chains[key]
+            self.__finish(callback, result, error)
+
+    def shutdown(self):
+        """waits for submitted tasks and dispatches their completions"""
+        self.__executor.shutdown(wait=True)
+        self.dispatch()
+        self.__wakeup_recv.close()
+        self.__wakeup_send.close()
+
+    def __run(self, fn, args, callback, key, previous, done):
+        if previous is not None:
+            previous.wait()
+        result, error = self.__call(fn, args)
+        # chain is released before completion is queued, so dispatch sees the event already set
+        done.set()
+        self.__completed.put((callback, result, error, key, done))
+        try:
+            self.__wakeup_send.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # socket buffer is full, the loop is going to wake up anyway
+        except OSError:
+            pass  # closed during shutdown
+
+    def __call(self, fn, args):
+        try:
+            return fn(*args), None
+        except Exception as e:
+            return None, e
+
+    def __finish(self, callback, result, error):
+        if callback is None:
+            if error is not None:
+                print(f"[Exception] BlockingIO: {error}")
+            return
+        try:
+            callback(result, error)
+        except Exception as e:
+            print(f"[Exception] BlockingIO.dispatch(): {e}")
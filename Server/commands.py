@@ -0,0 +1,255 @@
+import os
+import sys
+import inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import protocol
+import utility
+from account_manager import AccountManager
+
+
+# (success, optional message) returned by client command handlers
+Reply = tuple[bool, str|None]
+
+
+class CommandHandler:
+    """
+    Executes client commands against games manager,
+    transport independent so it is shared by Server and AsyncServer;
+    game side of commands goes through games_manager.submit, so with sharded games a command
+    is finished when its shard answers, while the server carries on with other clients
+    """
+    def __init__(self, games_manager):
+        self.games_manager = games_manager
+
+    def execute(self, am : AccountManager, msg : str) -> Reply:
+        """executes command to completion, games manager must answer before submit returns, as GameManager does"""
+        replies : list[Reply] = []
+        self.submit(am, msg, replies.append)
+        return replies[0]
+
+    def submit(self, am : AccountManager, msg : str, done) -> None:
+        """executes command, done(reply) is called once it has finished, possibly before submit returns"""
+        match msg.split():
+            case ["register", login, password]:
+                done(self.__register(am, login, password))
+
+            case ["login", login, password]:
+                done(self.__login(am, login, password))
+
+            case ["create", game_password]:
+                self.__create_new_game(am, game_password, done)
+
+            case ["join", game_id, game_password, color]:
+                if (args := utility.silent_convert((game_id, int))) is not None:
+                    self.__join_game(am, *args, game_password, color, done)
+                else:
+                    done((False, "Usage: join <game_id : int> <game_password : str> <color : str>"))
+
+            case ["vote", game_id, move]:
+                if (args := utility.silent_convert((game_id, int))) is not None:
+                    self.__vote(am, *args, move, done)
+                else:
+                    done((False, "Usage: vote <game_id : int> <move : str>"))
+
+            case ["rf", game_id]:
+                if (args := utility.silent_convert((game_id, int))) is not None:
+                    self.__refresh(am, *args, done)
+                else:
+                    done((False, "Usage: rf <game_id : int> [since_seq : int]"))
+
+            case ["rf", game_id, since]:
+                if (args := utility.silent_convert((game_id, int), (since, int))) is not None:
+                    self.__refresh_since(am, *args, done)
+                else:
+                    done((False, "Usage: rf <game_id : int> [since_seq : int]"))
+
+            case [protocol.BATCH_MSG, *_]:
+                if len(commands := protocol.split_batch(msg)) > protocol.MAX_BATCH_SIZE:
+                    done((False, protocol.BATCH_TOO_LARGE_MSG))
+                else:
+                    self.batch(am, commands, lambda results: done((True, protocol.make_batch_reply(results))))
+
+            case _:
+                done((True, None))
+
+    def batch(self, am : AccountManager, commands : list[str], done) -> None:
+        """
+        Executes commands of a batch, votes and refreshes are collected
+        and passed to games manager in a single call each, after the remaining commands have finished,
+        done(results) is called once all of them have
+        """
+        results : list[Reply|None] = [None] * len(commands)
+        votes : list[tuple[int, int, str]] = []
+        refreshes : list[tuple[int, int]] = []
+        conditional_refreshes : list[tuple[int, int, int]] = []
+        others : list[tuple[int, str]] = []
+        for i, cmd in enumerate(commands):
+            match cmd.split():
+                case ["vote", game_id, move] if (args := utility.silent_convert((game_id, int))) is not None:
+                    votes.append((i, *args, move))
+                case ["rf", game_id] if (args := utility.silent_convert((game_id, int))) is not None:
+                    refreshes.append((i, *args))
+                case ["rf", game_id, since] if (args := utility.silent_convert((game_id, int), (since, int))) is not None:
+                    conditional_refreshes.append((i, *args))
+                # account commands read files and hash passwords, the server runs them on its I/O pool
+                case [protocol.HELLO_MSG | protocol.CLIENT_DSC_MSG | protocol.BATCH_MSG | protocol.RESUME_MSG | "register" | "login", *_]:
+                    results[i] = (False, "Not allowed in batch")
+                case _:
+                    others.append((i, cmd))
+
+        def run_others(finished):
+            self.__all([lambda finished, i=i, cmd=cmd: self.submit(am, cmd, lambda reply: stored(i, reply, finished))
+                        for i, cmd in others], finished)
+
+        def stored(i, reply, finished):
+            results[i] = reply
+            finished()
+
+        def run_votes(finished):
+            if not votes:
+                finished()
+                return
+            if not am.logged_in:
+                voted([False] * len(votes), None, finished)
+                return
+            self.games_manager.submit("vote_many", [(game_id, move) for _, game_id, move in votes], am,
+                                      callback=lambda accepted, error: voted(accepted, error, finished))
+
+        def voted(accepted, error, finished):
+            if error is not None:
+                accepted = [False] * len(votes)
+            for (i, _, move), ok in zip(votes, accepted):
+                results[i] = (True, f"You have voted on {move}") if ok else (False, None)
+            finished()
+
+        def run_refreshes(finished):
+            self.__all([get_fens, get_deltas], finished)
+
+        def get_fens(finished):
+            if not refreshes:
+                finished()
+                return
+
+            def got(fens, error):
+                for n, (i, _) in enumerate(refreshes):
+                    fen = None if error is not None else fens[n]
+                    results[i] = (False, "No such game") if fen is None else (True, protocol.FEN_PREFIX + fen)
+                finished()
+
+            self.games_manager.submit("get_fens", [game_id for _, game_id in refreshes], callback=got)
+
+        def get_deltas(finished):
+            if not conditional_refreshes:
+                finished()
+                return
+
+            def got(deltas, error):
+                for n, (i, _, _) in enumerate(conditional_refreshes):
+                    delta = None if error is not None else deltas[n]
+                    results[i] = (False, "No such game") if delta is None else self.__format_delta(*delta)
+                finished()
+
+            self.games_manager.submit("get_deltas", [(game_id, since) for _, game_id, since in conditional_refreshes], callback=got)
+
+        # votes may need games joined by the other commands, refreshes should see the votes
+        run_others(lambda: run_votes(lambda: run_refreshes(lambda: done(results))))
+
+    def __all(self, steps, done) -> None:
+        """starts every step(finished), done() is called once each of them has called its finished()"""
+        left = [len(steps) + 1]
+
+        def finished():
+            left[0] -= 1
+            if left[0] == 0:
+                done()
+
+        for step in steps:
+            step(finished)
+        finished()
+
+    def __register(self, am : AccountManager, login : str, password : str) -> Reply:
+        if am.logged_in:
+            return False, "You are already logged in"
+        try:
+            am.create_account(login, password)
+            print("[Info]: New user registered")
+            return True, None
+        except:
+            print("[Info]: Unable to register")
+            return False, None
+
+    def __login(self, am : AccountManager, login : str, password : str) -> Reply:
+        if am.logged_in:
+            return False, "You are already logged in"
+        if am.login_now(login, password):
+            am.load()
+            return True, f"Hello {login}"
+        return False, None
+
+    def __create_new_game(self, am : AccountManager, game_password : str, done) -> None:
+        if not am.logged_in:
+            done((False, None))
+            return
+
+        def created(game_id, error):
+            if error is not None:
+                print(f"[Exception] new_game(): {error}")
+                done((False, None))
+            else:
+                done((True, f"Your game ID is {game_id}"))
+
+        self.games_manager.submit("new_game", am.login, game_password, callback=created)
+
+    def __join_game(self, am : AccountManager, game_id : int, game_password : str, color : str, done) -> None:
+        if not am.logged_in:
+            done((False, None))
+            return
+        color = "b" if color.lower() != "w" else "w"
+
+        def joined(_, error):
+            if error is not None:
+                done((False, "Wrong game password"))
+            else:
+                self.games_manager.submit("get_fen", game_id, callback=got_fen)
+
+        def got_fen(game_fen, error):
+            if error is not None:
+                done((False, "Wrong game password"))
+            else:
+                done((True, protocol.FEN_PREFIX + game_fen))
+
+        self.games_manager.submit("join_game", game_id, color, game_password, am, callback=joined)
+
+    def __vote(self, am : AccountManager, game_id : int, move : str, done) -> None:
+        if not am.logged_in:
+            done((False, None))
+            return
+        try:
+            color = am.get_color(game_id)
+        except:
+            done((False, None))
+            return
+        self.games_manager.submit("vote", game_id, color == "w", move, am,
+                                  callback=lambda _, error: done((False, None) if error is not None else (True, f"You have voted on {move}")))
+
+    def __refresh(self, am : AccountManager, game_id : int, done) -> None:
+        def got_fen(game_fen, error):
+            if error is not None:
+                done((False, "No such game"))
+                return
+            print("[Info]: sending", game_fen)
+            done((True, protocol.FEN_PREFIX + game_fen))
+
+        self.games_manager.submit("get_fen", game_id, callback=got_fen)
+
+    def __refresh_since(self, am : AccountManager, game_id : int, since : int, done) -> None:
+        self.games_manager.submit("get_delta", game_id, since,
+                                  callback=lambda delta, error: done((False, "No such game") if error is not None else self.__format_delta(*delta)))
+
+    def __format_delta(self, seq : int, moves : list[str]|None, fen : str|None) -> Reply:
+        if moves is None:
+            return True, protocol.FEN_PREFIX + fen
+        return True, protocol.make_delta(seq, moves)
@@ -1,4 +1,3 @@
-from queue import PriorityQueue
 from time import sleep
 import chess
 import chess.pgn
@@ -13,23 +12,91 @@ from datetime import datetime
 import database
 import account_manager
 import voting_system
+import scheduler
+import metrics
+import snapshot
+import move_cache
+import os
+import time
+import math
 
 FORMAT = "%m/%d/%Y, %H:%M:%S"
 SEPARATOR = ";"
 PATH = "data/"
 
 NO_GAME_IN_QUEUE = -1
+# seconds process_all spends resolving due games per call, the rest is left for the next call
+PROCESS_BUDGET = 0.01
+# fraction of players of the side to move whose votes resolve the move before its deadline, None always waits
+QUORUM = None
+# games finished since start kept in the reverse index per user, older ones are forgotten
+FINISHED_PER_USER = 100
+
+
+def shard_filename(filename, shard=0, shards=1):
+    """
+    returns name of file owned by given shard, e.g. ids_2.csv,
+    unsharded manager keeps the original name
+    """
+    if shards <= 1:
+        return filename
+    name, extension = filename.rsplit(".", 1)
+    return f"{name}_{shard}.{extension}"
+
+
+def write_pgn(path, pgn):
+    """writes PGN text of a game, returns time it took"""
+    start = time.perf_counter()
+    with open(path, "w") as f:
+        print(pgn, file=f, end="\n\n")
+    return time.perf_counter() - start
+
+
+def write_snapshot(path, data):
+    """writes snapshot data to a temporary file, then renames it over path, returns time it took"""
+    start = time.perf_counter()
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return time.perf_counter() - start
 
 
 class GameManager:
-    def __init__(self):
-        self.queue = PriorityQueue()
+    def __init__(self, shard=0, shards=1, process_budget=PROCESS_BUDGET, quorum=QUORUM):
+        """
+        :param shard: index of this manager when games are partitioned between processes
+        :param shards: number of partitions, manager owns games with game_id % shards == shard
+        :param process_budget: seconds process_all may take, None for no limit
+        :param quorum: fraction of players of the side to move, once they have voted the move is resolved
+            without waiting for its deadline, unless votes are tied; None disables it
+        """
+        self.queue = scheduler.TimingWheel()
+        # games taken out of the queue that process_all had no time for, game_id -> deadline, earliest first
+        self.backlog = {}
+        self.process_budget = process_budget
+        self.quorum = quorum
+        # VoteIngestor counting votes of crowd games in worker processes, see make_crowd_game
+        self.crowd = None
+        self.crowd_games = set()
         self.games = {}
         self.votes_archive = {}
-        self.new_id = 1
-        self.ongoing_games_db = database.Database("data/", "ongoing_games.csv")
-        self.game_id_db = database.Database("data/", "ids.csv")
-        self.finished_games_db = database.Database("data/", "finished.csv")
+        self.shard = shard
+        self.shards = shards
+        self.move_listeners = []
+        # executor of blocking writes, e.g. BlockingIO of the server, None writes inline
+        self.io = None
+        # legal moves of positions, shared by all games of the process
+        self.move_cache = move_cache.CACHE
+        # reverse index of participants, the last FINISHED_PER_USER finished games of each user are kept too
+        self.user_active = {}  # login -> game_ids of ongoing games
+        self.user_finished = {}  # login -> game_ids of games finished since start, oldest first, as dict keys
+        self.game_players = {}  # game_id -> (white logins, black logins) of ongoing game, the sets of the Game
+        self.new_id = 1 + (shard - 1) % shards  # smallest game_id owned by this shard
+        self.ongoing_games_db = database.Database("data/", shard_filename("ongoing_games.csv", shard, shards))
+        self.game_id_db = database.Database("data/", shard_filename("ids.csv", shard, shards))
+        self.finished_games_db = database.Database("data/", shard_filename("finished.csv", shard, shards))
 
 
     def new_game(self, creator, password, parameters=None):
@@ -42,43 +109,93 @@ class GameManager:
 
         new_game = game.Game(self.new_id, parameters, creator, password)
         new_vote = voting_system.Voter()
-        new_vote.new(new_game.get_legal_moves_uci())
+        new_vote.new(self.move_cache.get(new_game.board))
         self.votes_archive.update({self.new_id: []})
         self.games.update({self.new_id: (new_game, new_vote)})
-        self.queue.put((new_game.make_int(), self.new_id))
-        self.new_id += 1
+        self.index_game(self.new_id)
+        self.queue.schedule(self.new_id, new_game.make_int())
+        self.new_id += self.shards
         Data_id = [[self.new_id]]
-        self.game_id_db.write_labels(["next_game_will_have_id"], Data_id)
-        return self.new_id - 1
+        self.run_io("ids", self.game_id_db.write_labels, ["next_game_will_have_id"], Data_id)
+        return self.new_id - self.shards
+
+    def run_io(self, key, fn, *args, callback=None):
+        """
+        runs blocking write on io executor if there is one, writes with the same key keep their order
+        """
+        if self.io is None:
+            result = fn(*args)
+            if callback is not None:
+                callback(result, None)
+        else:
+            self.io.submit(fn, *args, callback=callback, key=key)
+
+    def submit(self, operation, *args, callback):
+        """
+        runs operation, e.g. "vote", and calls callback(result, exception) before returning,
+        same interface as ShardedGameManager.submit whose shards answer later
+        """
+        try:
+            result = getattr(self, operation)(*args)
+        except Exception as e:
+            callback(None, e)
+            return
+        callback(result, None)
+
+    def add_move_listener(self, listener):
+        """
+        :param listener: function called with (game_id, seq, move, fen) whenever a move is made,
+            seq is number of moves made in the game, move in format 'e2e4'
+        """
+        self.move_listeners.append(listener)
+
+    def notify_move(self, game_id, G):
+        seq = G.move_number()
+        move = G.get_last_move().uci()
+        fen = G.get_fen()
+        for listener in self.move_listeners:
+            listener(game_id, seq, move, fen)
+
+    def next_deadline(self):
+        """
+        returns timestamp at which the earliest scheduled game is due, a past one if there is backlog
+        returns None if there are no games scheduled
+        """
+        if self.backlog:
+            return next(iter(self.backlog.values()))
+        return self.queue.next_deadline()
 
     def process(self):
         """
-        process 1 game
+        process 1 game, if the earliest scheduled one is already due
         returns game that was processed
-        returns NO_GAME_IN_QUEUE if there are no games running
+        returns NO_GAME_IN_QUEUE if there are no games due
         """
 
         now = datetime.now()
-        # print(self.games)
-        if self.games == {}:
-            return NO_GAME_IN_QUEUE
-        p, game_id = self.queue.get()
-        if game_id is None:
+        due = self.queue.pop_due(now.timestamp(), 1)
+        if not due:
             return NO_GAME_IN_QUEUE
-        tmp = self.games.get(game_id)
-        if tmp is None:  # there are no games active as of this moment
-            return NO_GAME_IN_QUEUE
-        act_game, votes = tmp
+        with metrics.REGISTRY.time("game_process_seconds"):
+            return self.process_game(due[0])
 
-        if now.timestamp() < p:
-            print("PROCESSING - NOT YET ", now.timestamp(), p, act_game.get_fen())
-            self.queue.put((p, game_id))
-            return -1
-        print("NOW PROCESSING ", p, act_game.get_fen())
+    def process_game(self, game_id):
+        """
+        resolves votes of a game that was taken out of the queue
+        and schedules it again unless it has ended
+        returns game that was processed
+        """
+        act_game, votes = self.games.get(game_id)
+
+        print("NOW PROCESSING ", game_id, act_game.get_fen())
+        if game_id in self.crowd_games:
+            votes.load(*self.crowd.tally(game_id))
         # ... 'count' votes and make a move
-        counted_votes = votes.get_most_vote()
-        if len(counted_votes) == 1:  # exists exactly 1 vote with max. no votes (no tie)
-            act_game.make_move(counted_votes[0])
+        winner = votes.winner()
+        if winner is not None:  # exists exactly 1 vote with max. no votes (no tie)
+            # the position's entry is cached since votes.new, its chess.Move is pushed without parsing the UCI again
+            act_game.make_move_push(self.move_cache.get(act_game.board)[winner])
+            self.notify_move(game_id, act_game)
             # print(act_game.get_state())
             votes_dict = votes.votes()
             vote_hist = self.votes_archive.get(game_id)
@@ -88,35 +205,47 @@ class GameManager:
                 act_game.last_move_time = datetime.now()
 
                 #  ... save result to file
-                self.finished_games_db.write_labels([], [[game_id]], "a+")
+                self.run_io("finished", self.finished_games_db.write_labels, [], [[game_id]], "a+")
                 self.save_to_pgn(game_id)
                 self.games.pop(game_id)
+                self.__index_finished(game_id)
+                if game_id in self.crowd_games:
+                    self.crowd_games.discard(game_id)
+                    self.crowd.drop(game_id)
 
                 return game_id
 
-            votes.new(act_game.get_legal_moves_uci())
+            votes.new(self.move_cache.get(act_game.board))
+            if game_id in self.crowd_games:
+                self.crowd.new(game_id, votes.votes().keys())
         #else:
             #raise Exception("tie")
 
 
         act_game.last_move_time = datetime.now()
-        self.queue.put((act_game.make_int(), game_id))
+        self.queue.schedule(game_id, act_game.make_int())
         return game_id
 
     def process_all(self):
         """
-        process games while there exist games to be processed
+        process games that are due, extracted from the queue in one pass and added to the backlog,
+        earliest first until process_budget runs out, the rest stays in the backlog for the next call
         returns list of games that have been processed
-        returns NO_GAME_IN_QUEUE if there are no games running
         """
-
-        res_t = []
-        res = 0
-        while res != -1:
-            res = self.process()
-            if res != -1:
-                res_t.append(res)
-        return res_t
+        now = time.time()
+        self.backlog.update(self.queue.pop_due_deadlines(now))
+        processed = []
+        start = time.perf_counter()
+        while self.backlog:
+            if self.process_budget is not None and processed and time.perf_counter() - start >= self.process_budget:
+                break
+            game_id = next(iter(self.backlog))
+            deadline = self.backlog.pop(game_id)
+            metrics.REGISTRY.observe("game_lag_seconds", max(0.0, time.time() - deadline))
+            with metrics.REGISTRY.time("game_process_seconds"):
+                processed.append(self.process_game(game_id))
+        metrics.REGISTRY.set("games_backlog", len(self.backlog))
+        return processed
 
     def load(self):
         """
@@ -139,6 +268,55 @@ class GameManager:
 
         self.ongoing_games_db.write_labels(["game_id"], Data)
 
+    def metrics_snapshot(self):
+        """snapshot of the metrics registry of this process, with the size of its move cache"""
+        metrics.REGISTRY.set("move_cache_positions", len(self.move_cache))
+        return metrics.REGISTRY.snapshot()
+
+    def snapshot_path(self):
+        return PATH + shard_filename("snapshot.bin", self.shard, self.shards)
+
+    def save_snapshot(self, path=None, wait=False):
+        """
+        writes binary snapshot of all ongoing games, replacing the previous one atomically;
+        games are encoded right away, the file is written on io executor unless wait is set
+        """
+        path = self.snapshot_path() if path is None else path
+        for game_id in self.crowd_games:
+            self.games[game_id][1].load(*self.crowd.tally(game_id))
+        with metrics.REGISTRY.time("snapshot_encode_seconds"):
+            data = snapshot.encode_games(self)
+        if wait:
+            self.snapshot_written(write_snapshot(path, data), None)
+        else:
+            self.run_io("snapshot", write_snapshot, path, data, callback=self.snapshot_written)
+
+    def snapshot_written(self, duration, error):
+        if error is not None:
+            print(f"[Exception] save_snapshot(): {error}")
+            metrics.REGISTRY.inc("snapshot_write_errors_total")
+            return
+        metrics.REGISTRY.observe("snapshot_write_seconds", duration)
+
+    def load_snapshot(self, path=None):
+        """
+        restores games from snapshot written by save_snapshot, read in one go,
+        returns number of games restored, 0 if there is no snapshot;
+        snapshot that can't be read is moved aside before raising ValueError,
+        so the next save_snapshot doesn't overwrite the games in it
+        """
+        path = self.snapshot_path() if path is None else path
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            return snapshot.decode_games(self, data)
+        except Exception as e:
+            bad_path = f"{path}.bad-{int(time.time())}"
+            os.replace(path, bad_path)
+            raise ValueError(f"unreadable snapshot moved to {bad_path}: {e}")
+
     def vote(self, game_id, color, vote, AM):
         """
         :param game_id:
@@ -150,33 +328,182 @@ class GameManager:
         if not AM.vote_permission(game_id, color):
             raise Exception("user can't vote - wrong color/no permission")
 
+        move_number = self.cast_vote(game_id, vote, AM.login)
+        AM.vote(game_id, move_number, vote)
+
+    def cast_vote(self, game_id, vote, voter=None):
+        """
+        counts vote without checking user's permission
+        :param voter: login of the user, their earlier vote on this move is replaced,
+            they must play the side to move, so the ledger only holds players of that side
+        :return: number of the move that was voted on
+        """
         g, v = self.games.get(game_id)
-        v.vote(vote)
+        if voter is not None and voter not in (g.white if g.turn() else g.black):
+            raise Exception("user can't vote - not on move")
+        if game_id in self.crowd_games:
+            if vote not in v.votes():
+                raise Exception(f"illegal move {vote}")
+            self.crowd.vote(game_id, vote, voter)
+            return g.move_number()
+        v.vote(vote, voter)
+        if self.quorum is not None and voter is not None:
+            self.__check_quorum(game_id, g, v)
+        return g.move_number()
+
+    def __check_quorum(self, game_id, G, V):
+        """
+        makes game due now if quorum of players of the side to move has voted and there is a winner
+        """
+        players = G.white if G.turn() else G.black
+        needed = max(1, math.ceil(self.quorum * len(players)))
+        # cast_vote lets only players of the side to move into the ledger
+        if len(V.ledger()) < needed or game_id in self.backlog or V.winner() is None:
+            return
+        now = int(time.time())
+        if (deadline := self.queue.deadline(game_id)) is not None and deadline > now:
+            self.queue.schedule(game_id, now)
+            metrics.REGISTRY.inc("games_resolved_early_total")
+
+    def make_crowd_game(self, game_id):
+        """
+        from now on votes of the game are counted by self.crowd and merged when the move is resolved,
+        ballots cast so far are handed over to it
+        """
+        G, V = self.games.get(game_id)
+        if game_id in self.crowd_games:
+            return
+        self.crowd.new(game_id, V.votes().keys())
+        anonymous = dict(V.votes())
+        for voter, move in V.ledger().items():
+            self.crowd.vote(game_id, move, voter)
+            anonymous[move] -= 1
+        for move, count in anonymous.items():
+            for _ in range(count):
+                self.crowd.vote(game_id, move)
+        self.crowd_games.add(game_id)
+
+    def cast_votes(self, votes):
+        """
+        :param votes: list of (game_id, move) or (game_id, move, voter)
+        :return: list of move numbers voted on, None for votes that were rejected
+        """
+        res = []
+        for game_id, move, *voter in votes:
+            try:
+                res.append(self.cast_vote(game_id, move, *voter))
+            except:
+                res.append(None)
+        return res
+
+    def vote_many(self, votes, AM):
+        """
+        casts many votes of one user in a single pass
+        :param votes: list of (game_id, move) pairs
+        :param AM: account_manager object
+        :return: list of bools, whether corresponding vote was accepted
+        """
+        res = []
+        for game_id, move in votes:
+            try:
+                self.vote(game_id, AM.get_color(game_id) == 'w', move, AM)
+                res.append(True)
+            except:
+                res.append(False)
+        return res
+
+    def get_fens(self, game_ids):
+        """
+        :param game_ids: list of game ids
+        :return: list of fens of corresponding games, None for games that are not active
+        """
+        res = []
+        for game_id in game_ids:
+            tmp = self.games.get(game_id)
+            res.append(None if tmp is None else tmp[0].get_fen())
+        return res
+
+    def get_delta(self, game_id, since):
+        """
+        :param since: number of moves the client already knows
+        :return: (seq, moves made after since, None) if since is valid, else (seq, None, fen),
+            seq being number of moves made in the game
+        """
+        G = self.get_game(game_id)
+        seq = G.move_number()
+        if 0 <= since <= seq:
+            return seq, [move.uci() for move in G.board.move_stack[since:]], None
+        return seq, None, G.get_fen()
+
+    def get_deltas(self, requests):
+        """
+        :param requests: list of (game_id, since) pairs
+        :return: list of get_delta results, None for games that are not active
+        """
+        res = []
+        for game_id, since in requests:
+            res.append(self.get_delta(game_id, since) if game_id in self.games else None)
+        return res
 
-        AM.vote(game_id, g.move_number(), vote)
+    def index_game(self, game_id):
+        """
+        adds players of a game that has just been created or restored to the reverse index
+        """
+        G = self.get_game(game_id)
+        self.game_players[game_id] = (G.white, G.black)
+        for login in G.white | G.black:
+            self.user_active.setdefault(login, set()).add(game_id)
+
+    def __index_finished(self, game_id):
+        """moves finished game to users' finished games, its players are in its PGN from now on"""
+        white, black = self.game_players.pop(game_id, ((), ()))
+        for login in (*white, *black):
+            active = self.user_active.get(login)
+            if active is not None:
+                active.discard(game_id)
+                if not active:
+                    del self.user_active[login]
+            finished = self.user_finished.setdefault(login, dict())
+            finished[game_id] = None
+            if len(finished) > FINISHED_PER_USER:
+                del finished[next(iter(finished))]
 
     def user_active_games(self, AM):
         """
         :param AM: account_manager object
         :return: set
         """
-        user_games_set = AM.user_games()
-        active_games = self.games.keys()
-        return user_games_set & active_games  # intersection
+        return self.player_games(AM.login)[0]
 
     def user_past_games(self, AM):
         """
+        games user has joined which are not ongoing, including those finished before the start
         :param AM: account_manager object
         :return: set
         """
-        user_games_set = AM.user_games()
-        active_games = self.games.keys()
-        return user_games_set - active_games
+        return AM.user_games() - self.user_active.get(AM.login, set())
+
+    def player_games(self, login):
+        """
+        :return: (ongoing game_ids, game_ids of the last FINISHED_PER_USER games finished since start) of the user,
+            from the reverse index
+        """
+        return set(self.user_active.get(login, ())), set(self.user_finished.get(login, ()))
+
+    def players(self, game_id):
+        """
+        :return: (white logins, black logins) of an ongoing game
+        """
+        white, black = self.game_players.get(game_id)
+        return set(white), set(black)
 
     def get_game(self, game_id):
         G, V = self.games.get(game_id)
         return G
 
+    def get_fen(self, game_id):
+        return self.get_game(game_id).get_fen()
+
     def join_game(self, game_id, color, password, AM):
         """
         :param game_id: game_id int
@@ -189,6 +516,17 @@ class GameManager:
             raise Exception("Wrong password")
         AM.join_game(game_id, color)
         G.new_player(AM.login, color)
+        self.user_active.setdefault(AM.login, set()).add(game_id)
+
+    def add_player(self, game_id, color, password, login):
+        """
+        adds player to the game without updating his account_manager
+        """
+        G, V = self.games.get(game_id)
+        if G.password != password:
+            raise Exception("Wrong password")
+        G.new_player(login, color)
+        self.user_active.setdefault(login, set()).add(game_id)
 
     def save_to_pgn(self, game_id):
         pgn_game = chess.pgn.Game()
@@ -207,7 +545,15 @@ class GameManager:
         for move in G.board.move_stack[1:len(G.board.move_stack)]:
             node = node.add_variation(move)
 
-        print(pgn_game, file=open("data/pgn/" + str(game_id) + ".pgn", "w"), end="\n\n")
+        self.run_io(("pgn", game_id), write_pgn, "data/pgn/" + str(game_id) + ".pgn", str(pgn_game),
+                    callback=self.pgn_written)
+
+    def pgn_written(self, duration, error):
+        if error is not None:
+            print(f"[Exception] save_to_pgn(): {error}")
+            metrics.REGISTRY.inc("pgn_write_errors_total")
+            return
+        metrics.REGISTRY.observe("pgn_write_seconds", duration)
 
     def load_game(self, game_id):
         pgn = open(f"data/pgn/{game_id}.pgn")
@@ -235,13 +581,14 @@ class GameManager:
         P.from_string(dictionary_game.get('parameters'))
         G = game.Game(game_id, P, dictionary_game.get('creator'), dictionary_game.get('password'),
                       last_move=datetime.strptime(dictionary_game.get('last_move'), FORMAT))
-        G.load(white, black)
+        G.load(set(white), set(black))
         for move in chess_game.mainline_moves():
             G.make_move_push(move)
-        self.queue.put((G.make_int(), game_id))
+        self.queue.schedule(game_id, G.make_int())
         new_vote = voting_system.Voter()
-        new_vote.new(G.get_legal_moves_uci())
+        new_vote.new(self.move_cache.get(G.board))
         self.games.update({game_id: (G, new_vote)})
+        self.index_game(game_id)
         vote_hist = [None] * len(G.board.move_stack)
         for i in range(len(G.board.move_stack)):
             vote_hist[i] = chess_game.headers[f"Votes_move_{i + 1}"]
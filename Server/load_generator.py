@@ -0,0 +1,203 @@
+import os
+import sys
+import inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import asyncio
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import chess
+import protocol
+import utility
+
+
+PLAYERS_PER_GAME = 4
+CAPABILITIES = (protocol.CAP_COMPACT, protocol.CAP_TAGGED)
+
+
+class LoadClient:
+    """
+    Simulated player speaking protocol.py, it registers, logs in, creates or joins a game
+    and then refreshes its board and votes on a random legal move at a fixed rate;
+    requests are tagged and sent one at a time, so latency is measured per command
+    """
+    def __init__(self, index : int, run : str, games : dict[int, asyncio.Future], results : dict[str, list[float]], failures : dict[str, int]):
+        self.index = index
+        self.login = f"lg{run}_{index}"
+        self.color = "w" if index % 2 == 0 else "b"
+        self.games = games
+        self.results = results
+        self.failures = failures
+        self.reader : asyncio.StreamReader|None = None
+        self.writer : asyncio.StreamWriter|None = None
+        self.framing = protocol.FRAMING_LEGACY
+        self.next_request_id = 0
+        self.game_id : int|None = None
+        self.board = chess.Board()
+        self.voted_ply : int|None = None
+        self.moves_seen = 0
+
+    async def connect(self, host : str, port : int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        if (await protocol.async_recv_msg(self.reader)) is None:
+            raise Exception("server did not send client ID")
+        await protocol.async_send_msg(self.writer, " ".join([protocol.HELLO_MSG, *CAPABILITIES]))
+        if await self.reader.readexactly(1) != protocol.SERVER_ID:
+            raise Exception("server does not support capabilities")
+        await protocol.async_recv_msg(self.reader)
+        self.framing = protocol.framing_for(CAPABILITIES)
+
+    async def request(self, command : str, msg : str) -> tuple[bool, str|None]:
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        start = time.perf_counter()
+        await protocol.async_send_msg(self.writer, protocol.tag_msg(request_id, msg), framing=self.framing)
+        while (reply := await protocol.async_recv_msg(self.reader, framing=self.framing)) is not None:
+            if (parsed := protocol.parse_reply(reply)) is not None and parsed[0] == request_id:
+                break
+        else:
+            raise Exception("connection closed")
+        self.results.setdefault(command, []).append(time.perf_counter() - start)
+        _, ok, payload = parsed
+        if not ok:
+            self.failures[command] = self.failures.get(command, 0) + 1
+        return ok, payload
+
+    async def setup(self):
+        await self.request("register", f"register {self.login} pass")
+        await self.request("login", f"login {self.login} pass")
+        group = self.index // PLAYERS_PER_GAME
+        if self.index % PLAYERS_PER_GAME == 0:
+            ok, payload = await self.request("create", f"create pass{group}")
+            game_id = utility.silent_apply(payload.split()[-1], int) if ok and payload else None
+            self.games[group].set_result(game_id)
+        self.game_id = await self.games[group]
+        if self.game_id is not None:
+            await self.request("join", f"join {self.game_id} pass{group} {self.color}")
+
+    async def play(self, until : float, rate : float):
+        """one refresh, and a vote when it is this player's turn, every 1 / rate seconds"""
+        next_action = time.perf_counter()
+        while self.game_id is not None and time.perf_counter() < until:
+            ok, payload = await self.request("rf", f"rf {self.game_id} {self.board.ply()}")
+            if ok and payload is not None:
+                self.apply_refresh(payload)
+            if self.board.is_game_over():
+                break
+            if (self.board.turn == chess.WHITE) == (self.color == "w") and self.voted_ply != self.board.ply():
+                # teammates pick the same move, split votes would end in a tie and no move would be made
+                rng = random.Random(f"{self.game_id}:{self.board.ply()}")
+                move = rng.choice(sorted(move.uci() for move in self.board.legal_moves))
+                await self.request("vote", f"vote {self.game_id} {move}")
+                self.voted_ply = self.board.ply()
+            next_action += 1 / rate
+            await asyncio.sleep(max(0.0, next_action - time.perf_counter()))
+
+    def apply_refresh(self, payload : str):
+        if (delta := protocol.parse_delta(payload)) is not None:
+            seq, moves = delta
+            if self.board.ply() + len(moves) == seq:
+                for move in moves:
+                    self.board.push_uci(move)
+                self.moves_seen += len(moves)
+        elif payload.startswith(protocol.FEN_PREFIX):
+            self.board = chess.Board(payload[len(protocol.FEN_PREFIX):])
+
+    async def close(self):
+        if self.writer is not None:
+            await protocol.async_send_msg(self.writer, protocol.CLIENT_DSC_MSG, verbose=False, framing=self.framing)
+            self.writer.close()
+
+
+def percentile(samples : list[float], q : float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+async def run_load(host : str, port : int, clients : int, seconds : float, rate : float):
+    run = f"{int(time.time()) % 100000}"
+    games = {group: asyncio.get_running_loop().create_future() for group in range((clients + PLAYERS_PER_GAME - 1) // PLAYERS_PER_GAME)}
+    results : dict[str, list[float]] = dict()
+    failures : dict[str, int] = dict()
+    load_clients = [LoadClient(i, run, games, results, failures) for i in range(clients)]
+
+    await asyncio.gather(*(client.connect(host, port) for client in load_clients))
+    await asyncio.gather(*(client.setup() for client in load_clients))
+    start = time.perf_counter()
+    await asyncio.gather(*(client.play(start + seconds, rate) for client in load_clients))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(client.close() for client in load_clients))
+
+    total = sum(len(samples) for samples in results.values())
+    print(f"{clients} clients, {elapsed:.1f} s, {total} requests, {total / elapsed:.0f} requests/s, "
+          f"{max(client.moves_seen for client in load_clients)} moves made in the busiest game")
+    for command, samples in sorted(results.items()):
+        print(f"{command:>9}: {len(samples):8} requests, {failures.get(command, 0):6} failed, "
+              f"p50 {percentile(samples, 0.5) * 1000:8.3f} ms, p99 {percentile(samples, 0.99) * 1000:8.3f} ms")
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_local_server(shards : int = 1) -> tuple[subprocess.Popen, socket.socket, int, str]:
+    """
+    Starts server.py in a scratch directory, so accounts and games of the run don't end up in data/,
+    then makes it listen for clients and process games through its console;
+    returns the process, console socket, clients port and the scratch directory
+    """
+    workdir = tempfile.mkdtemp(prefix="load_generator_")
+    os.makedirs(os.path.join(workdir, "data", "pgn"))
+    console_port, clients_port = free_port(), free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(currentdir, "server.py"), str(console_port), str(shards)],
+                               cwd=workdir, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while True:
+        try:
+            console = socket.create_connection(("127.0.0.1", console_port), protocol.TIMEOUT)
+            break
+        except OSError:
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.1)
+    console.settimeout(protocol.TIMEOUT)
+    if protocol.recv_byte(console) != protocol.SERVER_ID:
+        raise Exception("unexpected console handshake")
+    protocol.send_msg(console, f"listen 127.0.0.1 {clients_port}")
+    protocol.send_msg(console, "process")
+    time.sleep(0.5)
+    return process, console, clients_port, workdir
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in (3, 4, 5):
+        print(f"Usage: {sys.argv[0]} <clients> <seconds> [actions_per_second] [shards] \n e.g. {sys.argv[0]} 200 30 2 1")
+        sys.exit(1)
+
+    clients, seconds = int(sys.argv[1]), float(sys.argv[2])
+    rate = float(sys.argv[3]) if len(sys.argv) >= 4 else 2.0
+    shards = int(sys.argv[4]) if len(sys.argv) == 5 else 1
+
+    process, console, port, workdir = start_local_server(shards)
+    try:
+        asyncio.run(run_load("127.0.0.1", port, clients, seconds, rate))
+    except KeyboardInterrupt:
+        print("\nCaught keyboard interrupt, exiting")
+    finally:
+        protocol.send_msg(console, protocol.SHUTDOWN_MSG, verbose=False)
+        console.close()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,149 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# upper bounds of latency histogram buckets in seconds, the last one catches everything
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets : tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value : float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q : float) -> float:
+        """upper bound of the bucket holding q-th quantile, 0 if nothing was observed"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    In-process registry of counters, gauges and histograms identified by name and labels,
+    meant to be updated from the server loop only, so it needs no locking
+    """
+    def __init__(self):
+        self.counters : dict[tuple[str, tuple], float] = dict()
+        self.gauges : dict[tuple[str, tuple], float] = dict()
+        self.histograms : dict[tuple[str, tuple], Histogram] = dict()
+
+    def inc(self, name : str, value : float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name : str, value : float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name : str, value : float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if (histogram := self.histograms.get(key)) is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name : str, **labels):
+        """observes duration of the with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        """picklable copy of all metrics, e.g. to be sent from a shard to the front-end"""
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "histograms": {key: (h.buckets, list(h.counts), h.count, h.sum) for key, h in self.histograms.items()},
+        }
+
+    def merge(self, snapshot : dict, **labels):
+        """
+        replaces metrics with those of snapshot taken in another process, with labels added,
+        e.g. shard="1", snapshots are cumulative so the previous copy is overwritten
+        """
+        def relabel(key):
+            name, own = key
+            return name, tuple(sorted({**dict(own), **labels}.items()))
+
+        for key, value in snapshot["counters"].items():
+            self.counters[relabel(key)] = value
+        for key, value in snapshot["gauges"].items():
+            self.gauges[relabel(key)] = value
+        for key, (buckets, counts, count, total) in snapshot["histograms"].items():
+            histogram = self.histograms[relabel(key)] = Histogram(buckets)
+            histogram.counts, histogram.count, histogram.sum = list(counts), count, total
+
+    def summary(self) -> str:
+        """human readable state of all metrics, used by console 'stats' command"""
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            average = histogram.sum / histogram.count if histogram.count else 0.0
+            lines.append(f"{name}{format_labels(labels)} count={histogram.count} avg={average * 1000:.3f}ms "
+                         f"p50<={histogram.quantile(0.5) * 1000:g}ms p99<={histogram.quantile(0.99) * 1000:g}ms")
+        return "\n".join(lines)
+
+    def to_prometheus(self) -> str:
+        """all metrics in Prometheus text exposition format"""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:g}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path : str):
+        """writes Prometheus text to path, replaced atomically so scrapers never see a partial file"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def format_labels(labels : tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# registry of this process, game shards running in worker processes have their own,
+# the server merges their snapshots into its registry under shard label
+REGISTRY = Metrics()
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+import metrics
+
+
+MAX_POSITIONS = 4096  # an entry of a middlegame position takes a few KB
+
+
+class MoveCache:
+    """
+    Bounded LRU of legal moves of positions, keyed by Zobrist hash of the board, so that
+    positions repeated across games, e.g. openings, generate their moves only once;
+    an entry maps UCI of every legal move to the move, in order of generation,
+    it is shared by all callers and must not be modified
+    """
+    def __init__(self, max_positions : int = MAX_POSITIONS):
+        self.max_positions = max_positions
+        self.hits = 0
+        self.misses = 0
+        self.__positions : OrderedDict[int, dict[str, chess.Move]] = OrderedDict()  # zobrist hash -> uci -> move
+
+    def get(self, board : chess.Board) -> dict[str, chess.Move]:
+        key = chess.polyglot.zobrist_hash(board)
+        if (moves := self.__positions.get(key)) is not None:
+            self.__positions.move_to_end(key)
+            self.hits += 1
+            metrics.REGISTRY.inc("move_cache_hits_total")
+            return moves
+
+        moves = {move.uci(): move for move in board.legal_moves}
+        self.__positions[key] = moves
+        if len(self.__positions) > self.max_positions:
+            self.__positions.popitem(last=False)
+        self.misses += 1
+        metrics.REGISTRY.inc("move_cache_misses_total")
+        return moves
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        self.__positions.clear()
+
+    def __len__(self) -> int:
+        return len(self.__positions)
+
+
+def benchmark(games : int = 500, moves : int = 30, book_plies : int = 8):
+    """
+    Compares the cache against generating UCI of legal moves of every position,
+    on random games that follow one of two most popular replies for the first book_plies moves,
+    so openings repeat across games as they do on the server
+    """
+    import random
+    import time
+
+    rng = random.Random(0)
+    boards = []
+    for _ in range(games):
+        board = chess.Board()
+        while len(board.move_stack) < moves and not board.is_game_over():
+            boards.append(board.copy(stack=False))
+            legal = sorted(board.legal_moves, key=chess.Move.uci)
+            board.push(rng.choice(legal[:2] if len(board.move_stack) < book_plies else legal))
+
+    start = time.perf_counter()
+    for board in boards:
+        list(map(chess.Move.uci, board.legal_moves))
+    generate_time = time.perf_counter() - start
+
+    cache = MoveCache()
+    hit_time = miss_time = 0.0
+    for board in boards:
+        hits = cache.hits
+        start = time.perf_counter()
+        cache.get(board)
+        if cache.hits > hits:
+            hit_time += time.perf_counter() - start
+        else:
+            miss_time += time.perf_counter() - start
+    print(f"{len(boards)} positions: generate {generate_time * 1000:.1f} ms, cache {(hit_time + miss_time) * 1000:.1f} ms, "
+          f"hit rate {cache.hit_rate() * 100:.1f}%")
+    print(f"per position: generate {generate_time / len(boards) * 1e6:.1f} us, "
+          f"hit {hit_time / max(cache.hits, 1) * 1e6:.1f} us, miss {miss_time / max(cache.misses, 1) * 1e6:.1f} us")
+
+
+# cache of this process, game shards running in worker processes have their own
+CACHE = MoveCache()
+
+
+if __name__ == "__main__":
+    benchmark()
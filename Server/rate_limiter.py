@@ -0,0 +1,117 @@
+import os
+import sys
+import inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import time
+import protocol
+
+
+# commands are limited per class, commands not listed here belong to CLASS_OTHER
+CLASS_VOTE = "vote"
+CLASS_REFRESH = "refresh"
+CLASS_ACCOUNT = "account"
+CLASS_GAME = "game"
+CLASS_OTHER = "other"
+COMMAND_CLASSES = {"vote": CLASS_VOTE, "rf": CLASS_REFRESH,
+                   "register": CLASS_ACCOUNT, "login": CLASS_ACCOUNT, protocol.RESUME_MSG: CLASS_ACCOUNT,
+                   "create": CLASS_GAME, "join": CLASS_GAME}
+
+# command class -> (tokens refilled per second, bucket capacity)
+DEFAULT_LIMITS = {CLASS_VOTE: (5.0, 20.0),
+                  CLASS_REFRESH: (10.0, 40.0),
+                  CLASS_ACCOUNT: (0.5, 5.0),
+                  CLASS_GAME: (1.0, 10.0),
+                  CLASS_OTHER: (10.0, 40.0)}
+
+# above this many keys buckets that have refilled completely are forgotten
+MAX_KEYS = 10_000
+
+
+def command_costs(msg : str) -> dict[str, int]:
+    """
+    Returns number of tokens command takes from bucket of each class, every command of a batch counts;
+    a batch over MAX_BATCH_SIZE is refused without being executed, so it costs as one command
+    """
+    commands = protocol.split_batch(msg) if msg.startswith(protocol.BATCH_MSG + " ") else [msg]
+    if len(commands) > protocol.MAX_BATCH_SIZE:
+        return {CLASS_OTHER: 1}
+    costs = dict()
+    for cmd in commands:
+        name, _, _ = cmd.strip().partition(" ")
+        command_class = COMMAND_CLASSES.get(name, CLASS_OTHER)
+        costs[command_class] = costs.get(command_class, 0) + 1
+    return costs
+
+
+class TokenBucket:
+    def __init__(self, rate : float, capacity : float, now : float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = now
+
+    def refill(self, now : float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def full(self, now : float) -> bool:
+        return self.tokens + (now - self.last) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    """
+    Token buckets of every command class for each key, e.g. connection id or account login,
+    a command is allowed only if buckets of all its classes have enough tokens;
+    a batch costing more than capacity is allowed once the bucket is full and leaves it in debt,
+    so it waits for no more than a full bucket and the average rate still holds
+    """
+    def __init__(self, limits : dict[str, tuple[float, float]] = DEFAULT_LIMITS):
+        self.limits = limits
+        self.__buckets : dict = dict()  # key -> command class -> TokenBucket
+
+    def allow(self, key, costs : dict[str, int], now : float|None = None) -> bool:
+        if (taken := self.check(key, costs, now)) is None:
+            return False
+        self.charge(taken)
+        return True
+
+    def check(self, key, costs : dict[str, int], now : float|None = None) -> list[tuple[TokenBucket, int]]|None:
+        """
+        returns (bucket, cost) pairs to be passed to charge if the command is within limits, None otherwise,
+        tokens are not taken yet, so a command checked against several limiters costs nothing unless all allow it
+        """
+        now = time.monotonic() if now is None else now
+        buckets = self.__buckets.get(key)
+        if buckets is None:
+            if len(self.__buckets) >= MAX_KEYS:
+                self.prune(now)
+            buckets = self.__buckets[key] = dict()
+
+        taken = []
+        for command_class, cost in costs.items():
+            if (bucket := buckets.get(command_class)) is None:
+                bucket = buckets[command_class] = TokenBucket(*self.limits.get(command_class, self.limits[CLASS_OTHER]), now)
+            bucket.refill(now)
+            if bucket.tokens < min(cost, bucket.capacity):
+                return None
+            taken.append((bucket, cost))
+        return taken
+
+    def charge(self, taken : list[tuple[TokenBucket, int]]):
+        for bucket, cost in taken:
+            bucket.tokens -= cost
+
+    def forget(self, key):
+        self.__buckets.pop(key, None)
+
+    def prune(self, now : float|None = None):
+        """forgets keys whose buckets are full, they would be created in the same state again"""
+        now = time.monotonic() if now is None else now
+        for key in [key for key, buckets in self.__buckets.items() if all(bucket.full(now) for bucket in buckets.values())]:
+            del self.__buckets[key]
+
+    def __len__(self) -> int:
+        return len(self.__buckets)
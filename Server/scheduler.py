@@ -0,0 +1,140 @@
+import heapq
+import random
+import time
+from queue import PriorityQueue
+
+
+class TimingWheel:
+    """
+    Schedule of game deadlines with one second resolution (Game.make_int),
+    games due in the same second share one slot, so scheduling, rescheduling
+    and cancelling are O(1) dict operations and the heap only orders distinct occupied seconds;
+    emptied slots are dropped lazily when they reach the heap head.
+    Not thread-safe, meant to be used from the server loop only
+    """
+    def __init__(self):
+        self.__slots : dict[int, dict[int, None]] = dict()  # deadline -> ordered set of game ids
+        self.__slot_heap : list[int] = []
+        self.__deadlines : dict[int, int] = dict()  # game id -> deadline
+
+    def __len__(self) -> int:
+        return len(self.__deadlines)
+
+    def __contains__(self, game_id : int) -> bool:
+        return game_id in self.__deadlines
+
+    def deadline(self, game_id : int) -> int|None:
+        return self.__deadlines.get(game_id)
+
+    def schedule(self, game_id : int, deadline : int):
+        """schedules game, or moves it if it is already scheduled"""
+        old = self.__deadlines.get(game_id)
+        if old == deadline:
+            return
+        if old is not None:
+            del self.__slots[old][game_id]
+        self.__deadlines[game_id] = deadline
+
+        slot = self.__slots.get(deadline)
+        if slot is None:
+            slot = self.__slots[deadline] = dict()
+            heapq.heappush(self.__slot_heap, deadline)
+        slot[game_id] = None
+
+    def cancel(self, game_id : int):
+        if (old := self.__deadlines.pop(game_id, None)) is not None:
+            del self.__slots[old][game_id]
+
+    def next_deadline(self) -> int|None:
+        """returns the earliest deadline or None if nothing is scheduled"""
+        while self.__slot_heap:
+            head = self.__slot_heap[0]
+            if self.__slots[head]:
+                return head
+            heapq.heappop(self.__slot_heap)
+            del self.__slots[head]
+        return None
+
+    def pop_due(self, now : float, limit : int|None = None) -> list[int]:
+        """
+        removes and returns ids of games whose deadline is not later than now,
+        earliest first, at most limit of them if limit is given
+        """
+        return [game_id for game_id, _ in self.pop_due_deadlines(now, limit)]
+
+    def pop_due_deadlines(self, now : float, limit : int|None = None) -> list[tuple[int, int]]:
+        """same as pop_due, returns (game_id, deadline) pairs"""
+        due = []
+        while (deadline := self.next_deadline()) is not None and deadline <= now:
+            slot = self.__slots[deadline]
+            while slot and (limit is None or len(due) < limit):
+                game_id = next(iter(slot))
+                del slot[game_id]
+                del self.__deadlines[game_id]
+                due.append((game_id, deadline))
+            if slot:
+                break
+        return due
+
+
+def benchmark(games : int = 100_000, horizon : int = 3600):
+    """
+    Compares TimingWheel against PriorityQueue with remove-and-reinsert
+    on scheduling, rescheduling and extracting games spread over horizon seconds
+    """
+    start_time = int(time.time())
+    deadlines = [start_time + random.randrange(horizon) for _ in range(games)]
+    new_deadlines = [d + random.randrange(1, 60) for d in deadlines]
+
+    wheel = TimingWheel()
+    start = time.perf_counter()
+    for game_id, deadline in enumerate(deadlines):
+        wheel.schedule(game_id, deadline)
+    schedule_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for game_id, deadline in enumerate(new_deadlines):
+        wheel.schedule(game_id, deadline)
+    for game_id in range(0, games, 10):
+        wheel.cancel(game_id)
+    reschedule_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extracted = 0
+    for now in range(start_time, start_time + horizon + 60):
+        extracted += len(wheel.pop_due(now))
+    extract_time = time.perf_counter() - start
+
+    print(f"TimingWheel, {games} games: schedule {games / schedule_time:12.0f} ops/s, "
+          f"reschedule+cancel {(games + games // 10) / reschedule_time:12.0f} ops/s, "
+          f"extract {extracted / extract_time:12.0f} games/s")
+
+    # baseline, the way GameManager used the queue: put, then get and put back until due
+    queue = PriorityQueue()
+    start = time.perf_counter()
+    for game_id, deadline in enumerate(deadlines):
+        queue.put((deadline, game_id))
+    schedule_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    extracted = 0
+    for now in range(start_time, start_time + horizon):
+        while True:
+            deadline, game_id = queue.get()
+            if deadline > now:
+                queue.put((deadline, game_id))
+                break
+            extracted += 1
+            if queue.empty():
+                break
+        if queue.empty():
+            break
+    extract_time = time.perf_counter() - start
+
+    print(f"PriorityQueue, {games} games: schedule {games / schedule_time:12.0f} ops/s, "
+          f"reschedule+cancel {'n/a':>12} ops/s, "
+          f"extract {extracted / extract_time:12.0f} games/s")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -9,8 +9,17 @@ import protocol
 import utility
 import selectors
 import socket
-from games_manager import GameManager
+from games_manager import GameManager, PROCESS_BUDGET, QUORUM
+from sharding import ShardedGameManager
 from account_manager import AccountManager
+from commands import CommandHandler
+from subscriptions import SubscriptionRegistry
+from rate_limiter import RateLimiter, command_costs, DEFAULT_LIMITS
+from blocking_io import BlockingIO
+from vote_ingest import VoteIngestor
+from sessions import SessionStore
+import metrics
+from collections import Counter
 import Parameters
 import time
 
@@ -21,8 +30,31 @@ CONSOLE_TO_SERVER = 2
 CLIENT_LISTENER = 3
 CLIENT_TO_SERVER = 4
 
+SHARD_EVENTS = 5
+SHARD_REPLIES = 7
+
+BLOCKING_IO_DONE = 6
+BLOCKING_IO_WORKERS = 4
+# processes counting votes of crowd games, None uses one per core
+CROWD_WORKERS = None
+
+MAX_CLIENTS = 1024
+
+SNAPSHOT_INTERVAL = 60  # seconds
+
+METRICS_PATH = "data/metrics.prom"
+METRICS_DUMP_INTERVAL = 15  # seconds
+# commands timed separately, anything else is reported as other so labels stay bounded
+METRIC_COMMANDS = {protocol.HELLO_MSG, protocol.CLIENT_DSC_MSG, protocol.BATCH_MSG, protocol.RESUME_MSG,
+                   "register", "login", "create", "join", "vote", "rf"}
+
+# rejection is encoded once, over the limit connections get it without any per client state
+SERVER_FULL_FRAME = b"".join(protocol.encode_frame(protocol.SERVER_FULL_MSG))
+
 class Server:
-    def __init__(self, host : str, port : int):
+    def __init__(self, host : str, port : int, shards : int = 1, overflow : str = protocol.OVERFLOW_COALESCE,
+                 max_clients : int = MAX_CLIENTS, limits : dict[str, tuple[float, float]] = DEFAULT_LIMITS,
+                 process_budget : float|None = PROCESS_BUDGET, quorum : float|None = QUORUM):
         self.__running : bool = False
 
         self.__console_listener : socket.socket|None = protocol.create_listening_socket(host, port)
@@ -37,40 +69,92 @@ class Server:
         self.__clients_listener : socket.socket|None = None
         self.__clients_sockets : dict[int,socket.socket] = dict()
         self.__clients_accounts : dict[int, AccountManager] = dict()
+        self.__clients_caps : dict[int, set[str]] = dict()
+        self.__clients_decoders : dict[int, protocol.FrameDecoder] = dict()
+        self.__clients_outbound : dict[int, protocol.OutboundQueue] = dict()
+        self.__clients_to_flush : set[int] = set()
+        # clients waiting for a command running on blocking I/O pool -> time it was started
+        self.__clients_busy : dict[int, float] = dict()
+        # session tokens of logged in clients, sessions of disconnected ones are kept in session store
+        self.__clients_tokens : dict[int, str] = dict()
+        self.__tokens_clients : dict[str, int] = dict()
+        self.__sessions = SessionStore()
+        # clients whose outbound queue overflowed with disconnect policy, dropped after the current iteration
+        self.__clients_overflowed : set[int] = set()
+
+        # outbound policy applied to new clients, counters are shared by all of them
+        self.__overflow : str = overflow
+        self.__overflow_counters : Counter = Counter()
+
+        # admission control, commands are limited per connection and per account
+        self.__max_clients : int = max_clients
+        self.__connection_limiter = RateLimiter(limits)
+        self.__account_limiter = RateLimiter(limits)
+        self.__rejected : Counter = Counter()
+
+        self.__metrics = metrics.REGISTRY
+        self.__next_metrics_dump : float = time.time() + METRICS_DUMP_INTERVAL
 
         self.__clients_counter : int = 0
 
-        self.__games_manager = GameManager()
+        # with more than one shard games live in worker processes and are processed there,
+        # either way due games are resolved for at most process_budget seconds per loop iteration
+        if shards <= 1:
+            self.__games_manager = GameManager(process_budget=process_budget, quorum=quorum)
+        else:
+            self.__games_manager = ShardedGameManager(shards, process_budget, quorum)
+        self.__commands = CommandHandler(self.__games_manager)
+        self.__subscriptions = SubscriptionRegistry()
+        self.__games_manager.add_move_listener(self.__push_move)
         self.__process = False
+        self.__blocking_io = BlockingIO(BLOCKING_IO_WORKERS)
+        if isinstance(self.__games_manager, GameManager):
+            self.__games_manager.io = self.__blocking_io
+        # shards restore their own games when they start
+        if isinstance(self.__games_manager, GameManager):
+            try:
+                print(f"[Info]: Restored {self.__games_manager.load_snapshot()} games from snapshot")
+            except Exception as e:
+                print(f"[Exception] load_snapshot(): {e}")
+                if os.path.exists(self.__games_manager.snapshot_path()):
+                    # it couldn't be moved aside, saving would overwrite the games in it
+                    print("[Error]: Refusing to start over an unreadable snapshot")
+                    exit(-1)
+        self.__next_snapshot : float = time.time() + SNAPSHOT_INTERVAL
 
         
 
         self.__sel : selectors.DefaultSelector|None = selectors.DefaultSelector()
         self.__sel.register(self.__console_listener, selectors.EVENT_READ, data=(CONSOLE_LISTENER, -1))
+        self.__sel.register(self.__blocking_io.wakeup_socket(), selectors.EVENT_READ, data=(BLOCKING_IO_DONE, -1))
+        if isinstance(self.__games_manager, ShardedGameManager):
+            for shard, conn in enumerate(self.__games_manager.event_connections()):
+                self.__sel.register(conn, selectors.EVENT_READ, data=(SHARD_EVENTS, shard))
+            for shard, conn in enumerate(self.__games_manager.reply_connections()):
+                self.__sel.register(conn, selectors.EVENT_READ, data=(SHARD_REPLIES, shard))
 
     def run(self):
         self.__running = True
         #self.__games_manager.load()
 
-        start_time = time.time_ns()
-        wait_time = 10
-
         while self.__running:
-            current_time = time.time_ns()
-            if (current_time - start_time) >= wait_time:
-                start_time = current_time
-                if self.__games_manager is not None:
-                    if self.__process:
-                        try:
-                            res = self.__games_manager.process_all()
-                            print(res)
-                        except:
-                            pass
-
-
-
-            events = self.__sel.select(0.5)
-            for key, _ in events:
+            # selector waits until the next game is due, or indefinitely for sockets if there is none
+            timeout = None
+            if self.__games_manager is not None and self.__process:
+                try:
+                    if (res := self.__games_manager.process_all()):
+                        print(res)
+                    if (deadline := self.__games_manager.next_deadline()) is not None:
+                        timeout = max(0.0, deadline - time.time())
+                except Exception as e:
+                    print(f"[Exception] process_all(): {e}")
+            until_dump = max(0.0, min(self.__next_metrics_dump, self.__next_snapshot) - time.time())
+            timeout = until_dump if timeout is None else min(timeout, until_dump)
+
+            events = self.__sel.select(timeout)
+            self.__metrics.inc("selector_wakeups_total")
+            self.__metrics.inc("selector_events_total", len(events))
+            for key, mask in events:
                 sock : socket.socket = key.fileobj
                 #socket id is only valid for CLIENT_TO_SERVER sockets, since it is a key in clients dictionary
                 sock_type, sock_id = key.data
@@ -87,18 +171,41 @@ class Server:
                         self.__disconnect_console()
 
 
+                elif sock_type == SHARD_EVENTS:
+                    if not self.__games_manager.dispatch_events(sock_id):
+                        print(f"[Error]: Shard {sock_id} has exited")
+                        self.__sel.unregister(sock)
+
+                elif sock_type == SHARD_REPLIES:
+                    if not self.__games_manager.dispatch_replies(sock_id):
+                        print(f"[Error]: Shard {sock_id} has exited")
+                        self.__sel.unregister(sock)
+
+                elif sock_type == BLOCKING_IO_DONE:
+                    self.__blocking_io.dispatch()
+
                 elif sock_type == CLIENT_LISTENER:
                     self.__accept_client()
                 elif sock_type == CLIENT_TO_SERVER:
                     id = sock_id
-                    if (msg := protocol.recv_msg(sock)) is not None:
-                        usr_name = id if not self.__clients_accounts[id].logged_in else self.__clients_accounts[id].login
-                        print(f"[{usr_name}]: {msg}")
-                        self.__handle_client_msg(sock_id, msg)
+                    if mask & selectors.EVENT_WRITE:
+                        self.__clients_to_flush.add(id)
+                    if not mask & selectors.EVENT_READ or id not in self.__clients_sockets.keys():
+                        continue
+                    if (received := protocol.recv_into(sock, self.__clients_decoders[id])):
+                        self.__metrics.inc("bytes_in_total", received)
+                        self.__handle_client_frames(id)
                     else:
                         print(f"Couldn't receive message from client {sock_id}")
                         self.__safe_disconnect_client(sock_id)
-                    pass
+
+            # replies produced by this iteration are written together
+            self.__flush_clients()
+
+            if time.time() >= self.__next_metrics_dump:
+                self.__dump_metrics()
+            if time.time() >= self.__next_snapshot:
+                self.__save_snapshot()
 
     # Console part
     def __accept_console(self):
@@ -145,7 +252,56 @@ class Server:
 
             case ["info"]:
                 print(f"Currently there are {len(self.__clients_sockets)} clients connected")
+                print(f"[Info]: Max clients {self.__max_clients}, rejected: {dict(self.__rejected)}")
+
+            case ["outbound"]:
+                pending = sum(outbound.size for outbound in self.__clients_outbound.values())
+                print(f"[Info]: Overflow policy {self.__overflow}, {pending} bytes pending, triggered: {dict(self.__overflow_counters)}")
+
+            case ["outbound", policy]:
+                if policy in protocol.OVERFLOW_POLICIES:
+                    self.__overflow = policy
+                    for outbound in self.__clients_outbound.values():
+                        outbound.overflow = policy
+                    print(f"[Info]: Overflow policy is now {policy}")
+                else:
+                    print(f"[Info]: Usage outbound [{'|'.join(protocol.OVERFLOW_POLICIES)}]")
+
 
+            case ["snapshot"]:
+                self.__save_snapshot()
+                print("[Info]: Snapshot started")
+
+            case ["stats"]:
+                if isinstance(self.__games_manager, ShardedGameManager):
+                    self.__games_manager.collect_metrics(self.__metrics)
+                print(self.__metrics.summary())
+                if isinstance(self.__games_manager, GameManager):
+                    cache = self.__games_manager.move_cache
+                    print(f"move_cache positions={len(cache)} hit_rate={cache.hit_rate() * 100:.1f}%")
+                else:
+                    # every shard has its own cache, known from the metrics it has sent
+                    counters, gauges = self.__metrics.counters, self.__metrics.gauges
+                    for shard in range(self.__games_manager.shards):
+                        labels = (("shard", str(shard)),)
+                        hits = counters.get(("move_cache_hits_total", labels), 0)
+                        lookups = hits + counters.get(("move_cache_misses_total", labels), 0)
+                        hit_rate = hits / lookups if lookups else 0.0
+                        print(f"move_cache shard={shard} positions={gauges.get(('move_cache_positions', labels), 0):g} hit_rate={hit_rate * 100:.1f}%")
+
+            case ["crowd", game_id]:
+                if (args := utility.silent_convert((game_id, int))) is None:
+                    print("[Info]: Usage crowd <game_id : int>")
+                elif not isinstance(self.__games_manager, GameManager):
+                    print("[Info]: Crowd games need an unsharded server")
+                else:
+                    try:
+                        if self.__games_manager.crowd is None:
+                            self.__games_manager.crowd = VoteIngestor(CROWD_WORKERS)
+                        self.__games_manager.make_crowd_game(*args)
+                        print(f"[Info]: Votes of game {game_id} are counted by {self.__games_manager.crowd.workers} workers")
+                    except Exception as e:
+                        print(f"[Exception] crowd: {e}")
 
             case ["process"]:
                 self.__process = not self.__process
@@ -162,6 +318,29 @@ class Server:
         self.__console_to_server_sock = None
         print("[Info]: Console disconnected")
 
+    def __save_snapshot(self, wait : bool = False):
+        """games are encoded on the loop, the file is written on blocking I/O pool, or by shards, unless wait is set"""
+        self.__next_snapshot = time.time() + SNAPSHOT_INTERVAL
+        try:
+            self.__games_manager.save_snapshot(wait=wait)
+        except Exception as e:
+            print(f"[Exception] __save_snapshot(): {e}")
+
+    def __dump_metrics(self, wait : bool = False):
+        """metrics of shards are collected first, the file is written once all of them have answered"""
+        self.__next_metrics_dump = time.time() + METRICS_DUMP_INTERVAL
+        if isinstance(self.__games_manager, ShardedGameManager):
+            self.__games_manager.collect_metrics(self.__metrics, callback=None if wait else self.__write_metrics)
+            if not wait:
+                return
+        self.__write_metrics()
+
+    def __write_metrics(self):
+        try:
+            self.__metrics.dump(METRICS_PATH)
+        except Exception as e:
+            print(f"[Exception] __dump_metrics(): {e}")
+
     # end of Console part
 
     # Client server communication part
@@ -189,10 +368,16 @@ class Server:
     def __accept_client(self):
         try:
             conn, addr = self.__clients_listener.accept()
+            if len(self.__clients_sockets) >= self.__max_clients:
+                self.__reject_client(conn)
+                return
             client_id : int = self.__get_unique_client_id()
-            conn.settimeout(protocol.TIMEOUT)
+            conn.setblocking(False)
             self.__clients_sockets[client_id] = conn
             self.__clients_accounts[client_id] = AccountManager()
+            self.__clients_caps[client_id] = set()
+            self.__clients_decoders[client_id] = protocol.FrameDecoder()
+            self.__clients_outbound[client_id] = protocol.OutboundQueue(protocol.OUTBOUND_MAX_SIZE, self.__overflow, self.__overflow_counters)
             self.__sel.register(conn, selectors.EVENT_READ, data=(CLIENT_TO_SERVER, client_id))
         except Exception as e:
             print(f"[Exception] __accept_client(): {e}")
@@ -201,21 +386,94 @@ class Server:
         
         #TODO CLIENT MANAGER
         print(f"[Info]: Accepted new client, addr: {addr}, ID: {client_id}")
-        if not (sent_successfully := protocol.send_msg(conn, f"{client_id}")):
-            print("[Error]: Couldn't send ID to client")
-            self.__safe_disconnect_client(client_id)
+        self.__send_msg_to_client(client_id, f"{client_id}")
 
-    def __send_byte_to_client(self, id : int, byte : bytes, err_msg : str = ""):
-        if id in self.__clients_sockets.keys():
-            if not (sent_successfully := protocol.send_byte(self.__clients_sockets[id], byte)):
-                print("[Error]: Couldn't send byte to client", err_msg)
-                self.__safe_disconnect_client(id)
+    def __reject_client(self, conn : socket.socket):
+        self.__rejected["connections"] += 1
+        try:
+            conn.setblocking(False)
+            conn.send(SERVER_FULL_FRAME)
+        except Exception:
+            pass
+        conn.close()
+
+    def __admit(self, id : int, msg : str) -> bool:
+        """
+        checks command against rate limits of the connection and of the account logged in on it,
+        tokens are taken from both only if both allow it
+        """
+        costs = command_costs(msg)
+        if (connection_taken := self.__connection_limiter.check(id, costs)) is None:
+            return False
+        am = self.__clients_accounts[id]
+        account_taken = []
+        if am.logged_in and (account_taken := self.__account_limiter.check(am.login, costs)) is None:
+            return False
+        self.__connection_limiter.charge(connection_taken)
+        self.__account_limiter.charge(account_taken)
+        return True
+
+    def __client_framing(self, id : int) -> int:
+        return protocol.framing_for(self.__clients_caps.get(id, ()))
+
+    def __send_byte_to_client(self, id : int, byte : bytes):
+        if id in self.__clients_outbound.keys():
+            self.__queue_for_client(id, byte)
         
-    def __send_msg_to_client(self, id : int, msg : str, err_msg : str = ""):
-        if id in self.__clients_sockets.keys():
-            if not (sent_successfully := protocol.send_msg(self.__clients_sockets[id], msg)):
-                print("[Error]: Couldn't send msg to client", err_msg)
+    def __send_msg_to_client(self, id : int, msg : str):
+        if id in self.__clients_outbound.keys():
+            self.__metrics.inc("frames_out_total")
+            self.__queue_for_client(id, *protocol.encode_frame(msg, self.__client_framing(id)))
+
+    def __queue_for_client(self, id : int, *buffers : bytes, key = None):
+        if not self.__clients_outbound[id].push(*buffers, key=key):
+            self.__clients_overflowed.add(id)
+        self.__clients_to_flush.add(id)
+
+    def __push_move(self, game_id : int, seq : int, move : str, fen : str):
+        """
+        Sends update to every client subscribed to the game,
+        the frame is encoded once per framing and the same buffers are queued for all of them,
+        updates of one game supersede each other when client's outbound queue is full
+        """
+        msg = protocol.make_update(game_id, seq, move, fen)
+        frames = dict()
+        for id in self.__subscriptions.subscribers(game_id):
+            framing = self.__client_framing(id)
+            if framing not in frames:
+                frames[framing] = protocol.encode_frame(msg, framing)
+            self.__queue_for_client(id, *frames[framing], key=(protocol.UPDATE_PREFIX, game_id))
+            self.__metrics.inc("frames_out_total")
+            self.__metrics.inc("updates_pushed_total")
+
+    def __flush_clients(self):
+        """
+        Writes queued data of clients without blocking,
+        EVENT_WRITE is registered only for clients whose data couldn't be written entirely,
+        clients that couldn't keep up with their outbound data are disconnected first
+        """
+        for id in self.__clients_overflowed:
+            if id in self.__clients_sockets.keys():
+                print(f"[Info]: Outbound queue of client {id} is full, disconnecting")
                 self.__safe_disconnect_client(id)
+        self.__clients_overflowed = set()
+
+        for id in self.__clients_to_flush:
+            if id not in self.__clients_sockets.keys():
+                continue
+            sock = self.__clients_sockets[id]
+            outbound = self.__clients_outbound[id]
+            sent = outbound.bytes_sent
+            flushed = outbound.flush(sock)
+            self.__metrics.inc("bytes_out_total", outbound.bytes_sent - sent)
+            if not flushed:
+                print("[Error]: Couldn't send data to client", id)
+                self.__safe_disconnect_client(id)
+                continue
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbound.pending() else 0)
+            if self.__sel.get_key(sock).events != events:
+                self.__sel.modify(sock, events, data=(CLIENT_TO_SERVER, id))
+        self.__clients_to_flush = set()
 
     def __disconnect_all_clients(self):
         for sock in list(self.__clients_sockets.values()):
@@ -226,113 +484,181 @@ class Server:
 
     def __safe_disconnect_client(self, client_id : int):
         if client_id in self.__clients_sockets.keys():
+            # last replies, e.g. confirmation of disconnect, are sent if socket accepts them right away
+            self.__clients_outbound[client_id].flush(self.__clients_sockets[client_id], verbose=False)
             self.__safe_unregister_and_close(self.__clients_sockets[client_id])
             del self.__clients_sockets[client_id]
+            if (token := self.__clients_tokens.pop(client_id, None)) is not None:
+                del self.__tokens_clients[token]
+                # account stays logged in, a reconnecting client can resume it with the token
+                self.__sessions.detach(token, self.__clients_accounts[client_id])
             del self.__clients_accounts[client_id]
+            del self.__clients_caps[client_id]
+            del self.__clients_decoders[client_id]
+            del self.__clients_outbound[client_id]
+            self.__subscriptions.remove(client_id)
+            self.__connection_limiter.forget(client_id)
+            self.__clients_busy.pop(client_id, None)
             
             #TODO CLIENT MANAGER
             print(f"[Info]: Client with ID {client_id} just disconnected")
         else:
             print("[Error]: tried to disconnect client who does not exist")
 
-    
-    def __handle_client_msg(self, id : int, msg : str):
-        match msg.split():
-            case ["register", login, password]:
-                self.__register(id, login, password)
-
-            case ["login", login, password]:
-                self.__login(id, login, password)
 
-            case ["create", game_password]:
-                self.__create_new_game(id, game_password)
-
-            case ["join", game_id, game_password, color]:
-                if (args := utility.silent_convert((game_id, int))) is not None:
-                    self.__join_game(id, *args, game_password, color)
-            
-            case ["vote", game_id, move]:
-                if (args := utility.silent_convert((game_id, int))) is not None:
-                    self.__vote(id, *args, move)
-            
-            case ["rf", game_id]:
-                if (args := utility.silent_convert((game_id, int))) is not None:
-                    self.__send_byte_to_client(id, protocol.CONFIRMATION_BYTE)
-                    game_fen = self.__games_manager.get_game(*args).get_fen()
-                    print("[Info]: sending", game_fen)
-                    self.__send_msg_to_client(id, protocol.FEN_PREFIX + game_fen)
+    def __handle_client_frames(self, id : int):
+        """
+        Handles received frames of the client in order, while its command runs on blocking I/O pool
+        the rest stays in decoder, also because hello may change framing of the frames after it
+        """
+        try:
+            decoder = self.__clients_decoders[id]
+            while id not in self.__clients_busy.keys() and (msg := decoder.next_msg()) is not None:
+                self.__metrics.inc("frames_in_total")
+                request_id, msg = protocol.untag_msg(msg)
+                # rejected commands are answered before anything else is done with them
+                if not self.__admit(id, msg):
+                    self.__rejected["commands"] += 1
+                    self.__metrics.inc("commands_rejected_total")
+                    self.__send_reply(id, request_id, False, protocol.RATE_LIMITED_MSG)
+                    continue
+                command, _, _ = msg.partition(" ")
+                # votes are the bulk of the traffic of busy games, they aren't echoed
+                if command != "vote":
+                    usr_name = id if not self.__clients_accounts[id].logged_in else self.__clients_accounts[id].login
+                    print(f"[{usr_name}]: {msg}")
+                command = command if command in METRIC_COMMANDS else "other"
+                start = time.perf_counter()
+                if self.__handle_client_msg(id, request_id, msg):
+                    self.__metrics.observe("command_seconds", time.perf_counter() - start, command=command)
+                if id not in self.__clients_sockets.keys():
+                    return
+        except ValueError as e:
+            print(f"[Error]: Malformed frame from client {id}: {e}")
+            self.__safe_disconnect_client(id)
+
+    def __handle_client_msg(self, id : int, request_id : int|None, msg : str) -> bool:
+        """returns False if command was handed over to blocking I/O pool or a shard and will be answered later"""
+        match msg.split():
+            case [protocol.HELLO_MSG, *capabilities]:
+                self.__hello(id, capabilities)
 
             case [protocol.CLIENT_DSC_MSG]:
-                self.__send_byte_to_client(id, protocol.CONFIRMATION_BYTE)
+                self.__send_reply(id, request_id, True)
                 self.__safe_disconnect_client(id)
-            case _:
-                self.__send_byte_to_client(id, protocol.CONFIRMATION_BYTE)
-                pass
-    
-
-
-    def __register(self, socket_id : int, login : str, password : str):
-        if self.__clients_accounts[socket_id].logged_in:
-                self.__send_msg_to_client(socket_id, "You are already logged in")
-        else:
-            try:
-                self.__clients_accounts[socket_id].create_account(login, password)
-                self.__send_byte_to_client(socket_id, protocol.CONFIRMATION_BYTE)
-                print("[Info]: New user registered")
-            except:
-                self.__send_byte_to_client(socket_id, protocol.FAILURE_BYTE)
-                print("[Info]: Unable to register")
-
-    def __login(self, socket_id : int, login : str, password : str):
-        if self.__clients_accounts[socket_id].logged_in:
-            self.__send_msg_to_client(socket_id, "You are already logged in")
-        else:
-            if self.__clients_accounts[socket_id].login_now(login, password):
-                self.__clients_accounts[socket_id].load()
-                self.__send_byte_to_client(socket_id, protocol.CONFIRMATION_BYTE)
-                self.__send_msg_to_client(socket_id, f"Hello {login}")
-            else:
-                self.__send_byte_to_client(socket_id, protocol.FAILURE_BYTE)
-
-    def __create_new_game(self, socket_id : int, game_password : str):
-        if self.__clients_accounts[socket_id].logged_in:
-            #TODO user id socket id shouldn't be the same
-            game_id = self.__games_manager.new_game(id, game_password)
-            self.__send_byte_to_client(socket_id, protocol.CONFIRMATION_BYTE)
-            self.__send_msg_to_client(socket_id, f"Your game ID is {game_id}")
-        else:
-            self.__send_byte_to_client(socket_id, protocol.FAILURE_BYTE)
 
+            case [protocol.RESUME_MSG, token]:
+                self.__send_reply(id, request_id, *self.__resume(id, token))
+                self.__after_command(id)
 
-    def __join_game(self, socket_id : int, game_id : int, game_password : str, color : str):
-        if self.__clients_accounts[socket_id].logged_in:
-            color = "b" if color.lower() != "w" else "w"
-            try:
-                self.__games_manager.join_game(game_id, color, game_password, self.__clients_accounts[socket_id])
-                self.__send_byte_to_client(socket_id, protocol.CONFIRMATION_BYTE)
-                game_fen = self.__games_manager.get_game(game_id).get_fen()
-                self.__send_msg_to_client(socket_id, protocol.FEN_PREFIX + game_fen)
-            except:
-                self.__send_byte_to_client(socket_id, protocol.FAILURE_BYTE)
-                self.__send_msg_to_client(socket_id, "Wrong game password")
-        else:
-            self.__send_byte_to_client(socket_id, protocol.FAILURE_BYTE)
+            case ["register" | "login", *_]:
+                # account files are read and written, and passwords hashed
+                self.__execute_blocking(id, request_id, msg)
+                return False
 
-    def __vote(self, socket_id : int, game_id : int, move : str):
-        if self.__clients_accounts[socket_id].logged_in:
-            print(f"{self.__clients_accounts[socket_id].login} wants to vote on {move}")
-            try:
-                am = self.__clients_accounts[socket_id]
-                color = am.get_color(game_id)
-                self.__games_manager.vote(game_id, color == "w", move, am)
-                self.__send_byte_to_client(socket_id, protocol.CONFIRMATION_BYTE)
-                self.__send_msg_to_client(socket_id, f"You have voted on {move}")
-            except:
-                self.__send_byte_to_client(socket_id, protocol.FAILURE_BYTE)
+            case _:
+                return self.__execute(id, request_id, msg)
+        return True
+
+    def __execute(self, id : int, request_id : int|None, msg : str) -> bool:
+        """
+        Runs command against games manager, a sharded one answers when the shard does,
+        meanwhile the client is busy as with blocking commands, while other clients are served
+        """
+        state = {"waiting": False}
+
+        def done(reply):
+            if state["waiting"]:
+                self.__command_done(id, request_id, msg, reply, None)
+            else:
+                state["reply"] = reply
+
+        self.__commands.submit(self.__clients_accounts[id], msg, done)
+        if "reply" in state.keys():
+            self.__send_reply(id, request_id, *state["reply"])
+            self.__after_command(id)
+            return True
+        state["waiting"] = True
+        self.__clients_busy[id] = time.perf_counter()
+        return False
+
+    def __execute_blocking(self, id : int, request_id : int|None, msg : str):
+        self.__clients_busy[id] = time.perf_counter()
+        # commands on one account run in order, so two registrations can't both pass the exists check
+        args = msg.split()
+        key = ("account", args[1]) if len(args) > 1 else None
+        self.__blocking_io.submit(self.__commands.execute, self.__clients_accounts[id], msg, key=key,
+                                  callback=lambda reply, error: self.__command_done(id, request_id, msg, reply, error))
+
+    def __command_done(self, id : int, request_id : int|None, msg : str, reply, error : Exception|None):
+        """Answers command completed on blocking I/O pool or by a shard, then carries on with the client's next frames"""
+        if id not in self.__clients_sockets.keys():
+            return
+        start = self.__clients_busy.pop(id)
+        if error is not None:
+            print(f"[Exception] __command_done(): {error}")
+            reply = (False, None)
+        self.__send_reply(id, request_id, *reply)
+        self.__after_command(id)
+        command, _, _ = msg.partition(" ")
+        command = command if command in METRIC_COMMANDS else "other"
+        self.__metrics.observe("command_seconds", time.perf_counter() - start, command=command)
+        self.__handle_client_frames(id)
+
+    def __after_command(self, id : int):
+        """Subscribes client to games it has joined and gives it session token once it has logged in"""
+        if id not in self.__clients_sockets.keys():
+            return
+        am = self.__clients_accounts[id]
+        if not am.logged_in:
+            return
+        caps = self.__clients_caps[id]
+        if protocol.CAP_PUSH in caps and protocol.CAP_TAGGED in caps:
+            self.__subscriptions.sync(id, am.games.keys())
+        if protocol.CAP_SESSION in caps and id not in self.__clients_tokens.keys():
+            token = self.__sessions.issue()
+            self.__clients_tokens[id] = token
+            self.__tokens_clients[token] = id
+            self.__send_msg_to_client(id, protocol.make_session(token))
+
+    def __resume(self, id : int, token : str) -> tuple[bool, str|None]:
+        """
+        Attaches logged in account of a session to this connection,
+        a connection still holding the session, e.g. one not noticed to be dead yet, is disconnected first
+        """
+        if self.__clients_accounts[id].logged_in:
+            return False, "You are already logged in"
+        if (holder := self.__tokens_clients.get(token)) is not None and holder != id:
+            self.__safe_disconnect_client(holder)
+        if (am := self.__sessions.resume(token)) is None:
+            return False, "Session expired"
+        self.__clients_accounts[id] = am
+        self.__clients_tokens[id] = token
+        self.__tokens_clients[token] = id
+        print(f"[Info]: Client {id} resumed session of {am.login}")
+        return True, f"Hello {am.login}"
+
+    def __send_reply(self, id : int, request_id : int|None, ok : bool, msg : str|None = None):
+        """
+        Tagged requests are answered with single reply message carrying the same request id,
+        legacy ones with confirmation/failure byte optionally followed by message
+        """
+        if request_id is not None:
+            self.__send_msg_to_client(id, protocol.make_reply(request_id, ok, msg))
         else:
-            self.__send_byte_to_client(socket_id, protocol.FAILURE_BYTE)
-
-
+            self.__send_byte_to_client(id, protocol.CONFIRMATION_BYTE if ok else protocol.FAILURE_BYTE)
+            if msg is not None:
+                self.__send_msg_to_client(id, msg)
+
+    def __hello(self, socket_id : int, capabilities : list[str]):
+        accepted = protocol.accept_capabilities(capabilities)
+        self.__send_byte_to_client(socket_id, protocol.SERVER_ID)
+        # answer is sent in current framing, negotiated one applies to messages after it
+        self.__send_msg_to_client(socket_id, " ".join([protocol.HELLO_MSG, *accepted]))
+        if socket_id in self.__clients_caps.keys():
+            self.__clients_caps[socket_id] = set(accepted)
+            self.__clients_decoders[socket_id].framing = self.__client_framing(socket_id)
+            print(f"[Info]: Client {socket_id} capabilities: {accepted}")
 
     # end of Client Server communication part
 
@@ -357,6 +683,17 @@ class Server:
 
             # TODO add disconnecing all clients
 
+            # pending writes are finished before the snapshot
+            self.__sel.unregister(self.__blocking_io.wakeup_socket())
+            self.__blocking_io.shutdown()
+            self.__save_snapshot(wait=True)
+            # shards are asked for their metrics before they are stopped
+            self.__dump_metrics(wait=True)
+            if isinstance(self.__games_manager, ShardedGameManager):
+                self.__games_manager.close()
+            elif self.__games_manager.crowd is not None:
+                self.__games_manager.crowd.close()
+
             self.__sel.close()
             self.__sel = None
             print("[Info]: Server closed")
@@ -366,11 +703,12 @@ class Server:
 
 if __name__ == "__main__":
 
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <console_port> \n e.g. {sys.argv[0]} 5051")
+    if len(sys.argv) not in (2, 3, 4) or (len(sys.argv) == 4 and sys.argv[3] not in protocol.OVERFLOW_POLICIES):
+        print(f"Usage: {sys.argv[0]} <console_port> [shards] [{'|'.join(protocol.OVERFLOW_POLICIES)}] \n e.g. {sys.argv[0]} 5051 4 coalesce")
         sys.exit(1)
 
-    server = Server("127.0.0.1", int(sys.argv[1]))
+    server = Server("127.0.0.1", int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) >= 3 else 1,
+                    sys.argv[3] if len(sys.argv) == 4 else protocol.OVERFLOW_COALESCE)
 
     try:
         server.run()
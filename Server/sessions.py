@@ -0,0 +1,51 @@
+import secrets
+import time
+from collections import OrderedDict
+
+from account_manager import AccountManager
+
+
+SESSION_TTL = 15 * 60  # seconds a detached session can be resumed for
+MAX_DETACHED = 10_000
+
+
+class SessionStore:
+    """
+    Logged in AccountManagers of disconnected clients, kept so that a reconnecting client
+    can resume its session with a token instead of logging in again;
+    detached sessions expire after ttl and the least recently detached ones are evicted beyond max_detached
+    """
+    def __init__(self, ttl : float = SESSION_TTL, max_detached : int = MAX_DETACHED):
+        self.ttl = ttl
+        self.max_detached = max_detached
+        self.__detached : OrderedDict[str, tuple[float, AccountManager]] = OrderedDict()  # token -> (expiry, account)
+
+    def issue(self) -> str:
+        return secrets.token_urlsafe(16)
+
+    def detach(self, token : str, am : AccountManager, now : float|None = None):
+        now = time.monotonic() if now is None else now
+        self.__detached.pop(token, None)
+        self.__detached[token] = (now + self.ttl, am)
+        self.__expire(now)
+        while len(self.__detached) > self.max_detached:
+            self.__detached.popitem(last=False)
+
+    def resume(self, token : str, now : float|None = None) -> AccountManager|None:
+        """returns account of detached session and forgets it, None if there is no such session or it has expired"""
+        now = time.monotonic() if now is None else now
+        self.__expire(now)
+        if (session := self.__detached.pop(token, None)) is None:
+            return None
+        return session[1]
+
+    def __expire(self, now : float):
+        # sessions are detached with the same ttl, so the oldest ones expire first
+        while self.__detached:
+            token, (expiry, _) = next(iter(self.__detached.items()))
+            if expiry > now:
+                break
+            del self.__detached[token]
+
+    def __len__(self) -> int:
+        return len(self.__detached)
@@ -0,0 +1,504 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from games_manager import GameManager, PROCESS_BUDGET, QUORUM
+
+
+# operations a shard worker executes on request of the front-end
+SHARD_OPERATIONS = ("new_game", "add_player", "cast_vote", "cast_votes", "get_fen", "get_fens", "get_delta", "get_deltas", "player_games", "players", "save_snapshot", "metrics_snapshot", "exit")
+STOP_SHARD = None
+
+
+class Sender:
+    """
+    Sends objects over a connection from its own thread, in order,
+    so the shard never blocks on a pipe the front-end is not draining at the moment,
+    e.g. because it is waiting for the shard's reply on another one
+    """
+    __STOP = object()
+
+    def __init__(self, conn):
+        self.__conn = conn
+        self.__queue : queue.SimpleQueue = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def send(self, obj):
+        self.__queue.put(obj)
+
+    def close(self, timeout : float = 1.0):
+        """sends what is queued, unless the front-end doesn't take it within timeout"""
+        self.__queue.put(self.__STOP)
+        self.__thread.join(timeout)
+
+    def __run(self):
+        while (obj := self.__queue.get()) is not self.__STOP:
+            try:
+                self.__conn.send(obj)
+            except Exception:
+                break  # front-end has gone
+
+
+def run_shard(shard, shards, conn, events_conn, process_budget=PROCESS_BUDGET, quorum=QUORUM):
+    """
+    Worker process owning every game with game_id % shards == shard,
+    it serves front-end requests and processes its own games when they are due,
+    moves it makes are sent to the front-end over events_conn
+    """
+    games_manager = GameManager(shard, shards, process_budget, quorum)
+    try:
+        if (restored := games_manager.load_snapshot()):
+            print(f"[Shard {shard}]: Restored {restored} games from snapshot")
+    except Exception as e:
+        print(f"[Exception] run_shard({shard}): {e}")
+        if os.path.exists(games_manager.snapshot_path()):
+            # it couldn't be moved aside, saving would overwrite the games in it
+            print(f"[Error]: Shard {shard} refuses to start over an unreadable snapshot")
+            conn.close()
+            events_conn.close()
+            return
+    events = Sender(events_conn)
+    replies = Sender(conn)
+    games_manager.add_move_listener(lambda *event: events.send(event))
+    running = True
+    while running:
+        deadline = games_manager.next_deadline()
+        timeout = None if deadline is None else max(0.0, deadline - time.time())
+        # every request that has arrived is served before the next slice of processing
+        while running and conn.poll(timeout):
+            timeout = 0
+            try:
+                request = conn.recv()
+            except EOFError:
+                running = False
+                break
+            if request is STOP_SHARD:
+                running = False
+                break
+            request_id, operation, args = request
+            try:
+                if operation not in SHARD_OPERATIONS:
+                    raise Exception(f"unknown operation {operation}")
+                replies.send((request_id, True, getattr(games_manager, operation)(*args)))
+            except Exception as e:
+                replies.send((request_id, False, str(e)))
+        if not running:
+            break
+        try:
+            if (res := games_manager.process_all()):
+                print(f"[Shard {shard}]:", res)
+        except Exception as e:
+            print(f"[Exception] run_shard({shard}): {e}")
+    replies.close()
+    events.close()
+    conn.close()
+    events_conn.close()
+
+
+class ShardedGameManager:
+    """
+    Front-end replacement of GameManager used by the server when games are sharded,
+    games are partitioned by game_id across worker processes, each owning its own GameManager;
+    account side of commands stays here, game side is routed to the owning shard over a pipe;
+    requests are tagged with ids, so the server doesn't wait for one shard's answer before sending the next
+    """
+    def __init__(self, shards, process_budget=PROCESS_BUDGET, quorum=QUORUM):
+        self.shards = shards
+        self.__next_shard = 0
+        self.__next_request_id = 0
+        # (shard, callback) of requests sent to shards and not answered yet, by request id
+        self.__pending : dict[int, tuple[int, object]] = dict()
+        # shards whose worker has exited, requests routed to them fail at once
+        self.__exited : set[int] = set()
+        self.__async_operations = {
+            "new_game": self.__new_game_async,
+            "join_game": self.__join_game_async,
+            "vote": self.__vote_async,
+            "vote_many": self.__vote_many_async,
+            "get_fen": self.__get_fen_async,
+            "get_fens": self.__get_fens_async,
+            "get_delta": self.__get_delta_async,
+            "get_deltas": self.__get_deltas_async,
+        }
+        self.__conns = []
+        self.__event_conns = []
+        self.__workers = []
+        self.move_listeners = []
+        for shard in range(shards):
+            conn, worker_conn = multiprocessing.Pipe()
+            events_conn, worker_events_conn = multiprocessing.Pipe(duplex=False)
+            worker = multiprocessing.Process(target=run_shard, args=(shard, shards, worker_conn, worker_events_conn, process_budget, quorum), daemon=True)
+            worker.start()
+            worker_conn.close()
+            worker_events_conn.close()
+            self.__conns.append(conn)
+            self.__event_conns.append(events_conn)
+            self.__workers.append(worker)
+        print(f"[Info]: Started {shards} game shards")
+
+    def shard_of(self, game_id):
+        return game_id % self.shards
+
+    def __check_running(self, shard):
+        if shard in self.__exited:
+            raise Exception(f"shard {shard} has exited")
+
+    def __send(self, shard, operation, args, callback):
+        """sends request tagged with new id, callback(result, error) is called once the shard has answered it"""
+        self.__check_running(shard)
+        request_id = self.__next_request_id
+        self.__next_request_id += 1
+        self.__pending[request_id] = (shard, callback)
+        try:
+            self.__conns[shard].send((request_id, operation, args))
+        except OSError:
+            del self.__pending[request_id]
+            self.__shard_exited(shard)
+            raise Exception(f"shard {shard} has exited")
+        return request_id
+
+    def __shard_exited(self, shard):
+        """fails every request the shard will never answer"""
+        if shard in self.__exited:
+            return
+        self.__exited.add(shard)
+        failed = [request_id for request_id, (owner, _) in self.__pending.items() if owner == shard]
+        for request_id in failed:
+            self.__complete(request_id, False, f"shard {shard} has exited")
+
+    def __call(self, shard, operation, *args):
+        """sends request and waits for its reply, replies to earlier requests are dispatched meanwhile"""
+        request_id = self.__send(shard, operation, args, None)
+        return self.__wait(shard, request_id)
+
+    def __wait(self, shard, request_id):
+        while True:
+            try:
+                answered, ok, result = self.__conns[shard].recv()
+            except (EOFError, OSError):
+                self.__pending.pop(request_id, None)
+                self.__shard_exited(shard)
+                raise Exception(f"shard {shard} has exited")
+            if answered == request_id:
+                break
+            self.__complete(answered, ok, result)
+        del self.__pending[request_id]
+        if not ok:
+            raise Exception(result)
+        return result
+
+    def __complete(self, request_id, ok, result):
+        _, callback = self.__pending.pop(request_id, (None, None))
+        if callback is None:
+            return
+        if ok:
+            callback(result, None)
+        else:
+            callback(None, Exception(result))
+
+    def __groups(self, items, key):
+        groups = dict()
+        for i, item in enumerate(items):
+            groups.setdefault(self.shard_of(key(item)), []).append(i)
+        return groups
+
+    def __call_grouped(self, operation, items, key):
+        """
+        sends one request per shard with all items it owns, then collects the results,
+        so shards work on their parts in parallel; results are returned in order of items
+        """
+        groups = self.__groups(items, key)
+        request_ids = {shard: self.__send(shard, operation, ([items[i] for i in indices],), None) for shard, indices in groups.items()}
+        res = [None] * len(items)
+        for shard, indices in groups.items():
+            for i, result in zip(indices, self.__wait(shard, request_ids[shard])):
+                res[i] = result
+        return res
+
+    def __send_grouped(self, operation, items, key, callback):
+        """
+        same as __call_grouped, callback(results, None) is called once every shard involved has answered,
+        items of a shard that has failed or exited get None results, like items the shard rejects
+        """
+        groups = self.__groups(items, key)
+        res = [None] * len(items)
+        state = {"left": len(groups) + 1}
+
+        def answered(indices, results, error):
+            if error is None:
+                for i, result in zip(indices, results):
+                    res[i] = result
+            state["left"] -= 1
+            if state["left"] == 0:
+                callback(res, None)
+
+        for shard, indices in groups.items():
+            try:
+                self.__send(shard, operation, ([items[i] for i in indices],),
+                            lambda results, error, indices=indices: answered(indices, results, error))
+            except Exception as e:
+                answered(indices, None, e)
+        answered([], [], None)
+
+    def submit(self, operation, *args, callback):
+        """
+        same as GameManager.submit, except that the game side runs on the owning shard,
+        so callback is called from dispatch_replies once the shard has answered
+        """
+        if operation not in self.__async_operations.keys():
+            callback(None, Exception(f"unknown operation {operation}"))
+            return
+        try:
+            self.__async_operations[operation](*args, callback=callback)
+        except Exception as e:
+            callback(None, e)
+
+    def reply_connections(self):
+        """connections that become readable when shard has answered requests, to be watched by server's selector"""
+        return list(self.__conns)
+
+    def dispatch_replies(self, shard):
+        """
+        completes requests the shard has answered, without blocking,
+        returns False if the shard has exited
+        """
+        conn = self.__conns[shard]
+        while conn.poll():
+            try:
+                request_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                self.__shard_exited(shard)
+                return False
+            self.__complete(request_id, ok, result)
+        return True
+
+    def new_game(self, creator, password, parameters=None):
+        return self.__call(self.__round_robin(), "new_game", creator, password, parameters)
+
+    def __new_game_async(self, creator, password, parameters=None, *, callback):
+        self.__send(self.__round_robin(), "new_game", (creator, password, parameters), callback)
+
+    def __round_robin(self):
+        shard = self.__next_shard
+        self.__next_shard = (self.__next_shard + 1) % self.shards
+        return shard
+
+    def join_game(self, game_id, color, password, AM):
+        if game_id in AM.games.keys():
+            raise Exception('already joined')
+        self.__call(self.shard_of(game_id), "add_player", game_id, color, password, AM.login)
+        AM.join_game(game_id, color)
+
+    def __join_game_async(self, game_id, color, password, AM, *, callback):
+        if game_id in AM.games.keys():
+            raise Exception('already joined')
+
+        def added(_, error):
+            if error is None:
+                try:
+                    AM.join_game(game_id, color)
+                except Exception as e:
+                    error = e
+            callback(None, error)
+
+        self.__send(self.shard_of(game_id), "add_player", (game_id, color, password, AM.login), added)
+
+    def vote(self, game_id, color, vote, AM):
+        if not AM.vote_permission(game_id, color):
+            raise Exception("user can't vote - wrong color/no permission")
+        move_number = self.__call(self.shard_of(game_id), "cast_vote", game_id, vote, AM.login)
+        AM.vote(game_id, move_number, vote)
+
+    def __vote_async(self, game_id, color, vote, AM, *, callback):
+        if not AM.vote_permission(game_id, color):
+            raise Exception("user can't vote - wrong color/no permission")
+
+        def cast(move_number, error):
+            if error is None:
+                AM.vote(game_id, move_number, vote)
+            callback(None, error)
+
+        self.__send(self.shard_of(game_id), "cast_vote", (game_id, vote, AM.login), cast)
+
+    def __permitted(self, votes, AM):
+        permitted = [game_id in AM.games.keys() and AM.vote_permission(game_id, AM.get_color(game_id) == 'w') for game_id, _ in votes]
+        allowed = [(game_id, move, AM.login) for (game_id, move), ok in zip(votes, permitted) if ok]
+        return permitted, allowed
+
+    def __votes_cast(self, votes, permitted, move_numbers, AM):
+        move_numbers = iter(move_numbers)
+        res = []
+        for (game_id, move), ok in zip(votes, permitted):
+            move_number = next(move_numbers) if ok else None
+            if move_number is not None:
+                AM.vote(game_id, move_number, move)
+            res.append(move_number is not None)
+        return res
+
+    def vote_many(self, votes, AM):
+        permitted, allowed = self.__permitted(votes, AM)
+        return self.__votes_cast(votes, permitted, self.__call_grouped("cast_votes", allowed, lambda vote: vote[0]), AM)
+
+    def __vote_many_async(self, votes, AM, *, callback):
+        permitted, allowed = self.__permitted(votes, AM)
+
+        def cast(move_numbers, error):
+            if error is not None:
+                callback(None, error)
+            else:
+                callback(self.__votes_cast(votes, permitted, move_numbers, AM), None)
+
+        self.__send_grouped("cast_votes", allowed, lambda vote: vote[0], cast)
+
+    def get_fen(self, game_id):
+        return self.__call(self.shard_of(game_id), "get_fen", game_id)
+
+    def __get_fen_async(self, game_id, *, callback):
+        self.__send(self.shard_of(game_id), "get_fen", (game_id,), callback)
+
+    def get_fens(self, game_ids):
+        return self.__call_grouped("get_fens", game_ids, lambda game_id: game_id)
+
+    def __get_fens_async(self, game_ids, *, callback):
+        self.__send_grouped("get_fens", game_ids, lambda game_id: game_id, callback)
+
+    def add_move_listener(self, listener):
+        """same as GameManager.add_move_listener, listeners are called by dispatch_events"""
+        self.move_listeners.append(listener)
+
+    def event_connections(self):
+        """connections that become readable when shard has made moves, to be watched by server's selector"""
+        return list(self.__event_conns)
+
+    def dispatch_events(self, shard):
+        """
+        passes moves reported by shard to listeners, without blocking,
+        returns False if the shard has exited
+        """
+        conn = self.__event_conns[shard]
+        while conn.poll():
+            try:
+                event = conn.recv()
+            except (EOFError, OSError):
+                self.__shard_exited(shard)
+                return False
+            for listener in self.move_listeners:
+                listener(*event)
+        return True
+
+    def get_delta(self, game_id, since):
+        return self.__call(self.shard_of(game_id), "get_delta", game_id, since)
+
+    def __get_delta_async(self, game_id, since, *, callback):
+        self.__send(self.shard_of(game_id), "get_delta", (game_id, since), callback)
+
+    def get_deltas(self, requests):
+        return self.__call_grouped("get_deltas", requests, lambda request: request[0])
+
+    def __get_deltas_async(self, requests, *, callback):
+        self.__send_grouped("get_deltas", requests, lambda request: request[0], callback)
+
+    def user_active_games(self, AM):
+        return self.player_games(AM.login)[0]
+
+    def user_past_games(self, AM):
+        return AM.user_games() - self.user_active_games(AM)
+
+    def player_games(self, login):
+        """asks every running shard, user may play games owned by any of them"""
+        request_ids = {shard: self.__send(shard, "player_games", (login,), None) for shard in self.__running()}
+        active, finished = set(), set()
+        for shard, request_id in request_ids.items():
+            shard_active, shard_finished = self.__wait(shard, request_id)
+            active |= shard_active
+            finished |= shard_finished
+        return active, finished
+
+    def players(self, game_id):
+        return self.__call(self.shard_of(game_id), "players", game_id)
+
+    def next_deadline(self):
+        """shards process their games themselves"""
+        return None
+
+    def process_all(self):
+        return []
+
+    def save_snapshot(self, wait=False):
+        """
+        every running shard writes snapshot of its own games, one that has exited keeps its last one;
+        unless wait is set, errors are reported from dispatch_replies and the front-end doesn't wait for the writes
+        """
+        if not wait:
+            for shard in self.__running():
+                self.__send(shard, "save_snapshot", (), lambda _, error, shard=shard: self.__snapshot_saved(shard, error))
+            return
+        request_ids = {shard: self.__send(shard, "save_snapshot", (), None) for shard in self.__running()}
+        for shard, request_id in request_ids.items():
+            try:
+                self.__wait(shard, request_id)
+            except Exception as e:
+                print(f"[Exception] save_snapshot({shard}): {e}")
+
+    def collect_metrics(self, registry, callback=None):
+        """
+        merges metrics of every running shard into registry under shard label,
+        callback() is called once all shards have answered, without it the front-end waits for them
+        """
+        if callback is None:
+            request_ids = {shard: self.__send(shard, "metrics_snapshot", (), None) for shard in self.__running()}
+            for shard, request_id in request_ids.items():
+                try:
+                    registry.merge(self.__wait(shard, request_id), shard=str(shard))
+                except Exception as e:
+                    print(f"[Exception] collect_metrics({shard}): {e}")
+            return
+        running = self.__running()
+        state = {"left": len(running) + 1}
+
+        def collected(shard, snapshot, error):
+            if error is not None:
+                print(f"[Exception] collect_metrics({shard}): {error}")
+            elif snapshot is not None:
+                registry.merge(snapshot, shard=str(shard))
+            state["left"] -= 1
+            if state["left"] == 0:
+                callback()
+
+        for shard in running:
+            try:
+                self.__send(shard, "metrics_snapshot", (), lambda snapshot, error, shard=shard: collected(shard, snapshot, error))
+            except Exception as e:
+                collected(shard, None, e)
+        collected(None, None, None)
+
+    def __snapshot_saved(self, shard, error):
+        if error is not None:
+            print(f"[Exception] save_snapshot({shard}): {error}")
+
+    def exit(self):
+        for shard in self.__running():
+            try:
+                self.__call(shard, "exit")
+            except Exception as e:
+                print(f"[Exception] exit({shard}): {e}")
+
+    def __running(self):
+        return [shard for shard in range(self.shards) if shard not in self.__exited]
+
+    def close(self):
+        for conn in self.__conns:
+            try:
+                conn.send(STOP_SHARD)
+            except Exception:
+                pass
+        for worker in self.__workers:
+            worker.join(1)
+        for conn in self.__conns + self.__event_conns:
+            conn.close()
+        self.__conns = []
+        self.__event_conns = []
+        self.__workers = []
@@ -0,0 +1,250 @@
+import json
+import struct
+from array import array
+from datetime import datetime
+
+import chess
+import Parameters
+import game
+import voting_system
+
+
+# file layout, all integers big endian:
+#   header: MAGIC, VERSION, next game id, number of games
+#   game:   GAME_HEADER, then creator, password, anonymous, initial FEN (strings prefixed by u16 length),
+#           white and black logins (u16 count of strings), packed moves (u32 count of u16),
+#           pending votes and votes of every move made (u16 count of (u16 move, u32 votes) pairs),
+#           voters of pending votes (u32 count of login string and u16 move), since version 2
+MAGIC = b"MCSN"
+VERSION = 2
+# versions decode_games still reads, version 1 has no voters, its ballots are restored as anonymous
+READ_VERSIONS = (1, 2)
+FILE_HEADER = struct.Struct("!4sHII")
+# game_id, deadline (0 if not scheduled), last move time, start time, move time
+GAME_HEADER = struct.Struct("!IQddd")
+U16 = struct.Struct("!H")
+U32 = struct.Struct("!I")
+VOTE = struct.Struct("!HI")
+
+BIG_ENDIAN_HOST = array("H", [1]).tobytes() == b"\x00\x01"
+
+
+def pack_move(move : chess.Move) -> int:
+    """from square in bits 0-5, to square in bits 6-11, promotion piece type in bits 12-14"""
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def unpack_move(packed : int) -> chess.Move:
+    return chess.Move(packed & 63, packed >> 6 & 63, packed >> 12 or None)
+
+
+def pack_uci(uci : str) -> int:
+    return pack_move(chess.Move.from_uci(uci))
+
+
+def unpack_uci(packed : int) -> str:
+    return unpack_move(packed).uci()
+
+
+class Writer:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def struct(self, fmt : struct.Struct, *values):
+        self.buffer += fmt.pack(*values)
+
+    def string(self, value : str):
+        encoded = str(value).encode("utf-8")
+        self.buffer += U16.pack(len(encoded)) + encoded
+
+    def strings(self, values):
+        values = list(values)
+        self.buffer += U16.pack(len(values))
+        for value in values:
+            self.string(value)
+
+    def moves(self, moves : list[chess.Move]):
+        packed = array("H", map(pack_move, moves))
+        if not BIG_ENDIAN_HOST:
+            packed.byteswap()
+        self.buffer += U32.pack(len(packed)) + packed.tobytes()
+
+    def votes(self, votes : dict[str, int]):
+        self.buffer += U16.pack(len(votes))
+        for uci, count in votes.items():
+            self.buffer += VOTE.pack(pack_uci(uci), count)
+
+    def ledger(self, ledger : dict[str, str]):
+        self.buffer += U32.pack(len(ledger))
+        for voter, uci in ledger.items():
+            self.string(voter)
+            self.buffer += U16.pack(pack_uci(uci))
+
+
+class Reader:
+    def __init__(self, data : bytes):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def struct(self, fmt : struct.Struct) -> tuple:
+        values = fmt.unpack_from(self.data, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def string(self) -> str:
+        length, = self.struct(U16)
+        value = str(self.data[self.offset:self.offset + length], "utf-8")
+        self.offset += length
+        return value
+
+    def strings(self) -> list[str]:
+        count, = self.struct(U16)
+        return [self.string() for _ in range(count)]
+
+    def moves(self) -> list[chess.Move]:
+        count, = self.struct(U32)
+        packed = array("H")
+        packed.frombytes(self.data[self.offset:self.offset + 2 * count])
+        if not BIG_ENDIAN_HOST:
+            packed.byteswap()
+        self.offset += 2 * count
+        return [unpack_move(move) for move in packed]
+
+    def votes(self) -> dict[str, int]:
+        count, = self.struct(U16)
+        votes = dict()
+        for _ in range(count):
+            packed, votes_count = self.struct(VOTE)
+            votes[unpack_uci(packed)] = votes_count
+        return votes
+
+    def ledger(self) -> dict[str, str]:
+        count, = self.struct(U32)
+        ledger = dict()
+        for _ in range(count):
+            voter = self.string()
+            packed, = self.struct(U16)
+            ledger[voter] = unpack_uci(packed)
+        return ledger
+
+
+def encode_games(games_manager) -> bytes:
+    """serializes every ongoing game of games manager"""
+    writer = Writer()
+    writer.struct(FILE_HEADER, MAGIC, VERSION, games_manager.new_id, len(games_manager.games))
+    for game_id, (G, V) in games_manager.games.items():
+        P = G.parameters
+        deadline = games_manager.queue.deadline(game_id) or games_manager.backlog.get(game_id, 0)
+        writer.struct(GAME_HEADER, game_id, deadline,
+                      G.last_move_time.timestamp(), P.start_time.timestamp(), float(P.move_time))
+        writer.string(G.creator)
+        writer.string(G.password)
+        writer.string(P.anonymous)
+        writer.string(G.board.root().fen())
+        writer.strings(G.white)
+        writer.strings(G.black)
+        writer.moves(G.board.move_stack)
+        writer.votes(V.votes())
+        archive = games_manager.votes_archive.get(game_id, [])
+        writer.struct(U32, len(archive))
+        for votes in archive:
+            # games loaded from PGN keep votes as header strings
+            writer.votes(json.loads(votes.replace('\'', '"')) if isinstance(votes, str) else votes)
+        writer.ledger({voter: move for voter, move in V.ledger().items() if voter is not None})
+    return bytes(writer.buffer)
+
+
+def decode_games(games_manager, data : bytes) -> int:
+    """
+    restores games written by encode_games into games manager,
+    moves are pushed without parsing or legality checks;
+    games manager is changed only once the whole snapshot has been read,
+    raises ValueError if it can't be;
+    returns number of games restored
+    """
+    reader = Reader(data)
+    magic, version, new_id, count = reader.struct(FILE_HEADER)
+    if magic != MAGIC or version not in READ_VERSIONS:
+        raise ValueError(f"unsupported snapshot {magic!r} version {version}")
+
+    games = []
+    for _ in range(count):
+        game_id, deadline, last_move_time, start_time, move_time = reader.struct(GAME_HEADER)
+        creator, password, anonymous, fen = reader.string(), reader.string(), reader.string(), reader.string()
+        P = Parameters.Parameters()
+        P.new(datetime.fromtimestamp(start_time), int(move_time) if move_time.is_integer() else move_time, anonymous)
+        G = game.Game(game_id, P, creator, password, fen, last_move=datetime.fromtimestamp(last_move_time))
+        G.load(set(reader.strings()), set(reader.strings()))
+        for move in reader.moves():
+            G.make_move_push(move)
+
+        V = voting_system.Voter()
+        vote_counter = reader.votes()
+        archive_length, = reader.struct(U32)
+        archive = [reader.votes() for _ in range(archive_length)]
+        V.load(vote_counter, reader.ledger() if version >= 2 else None)
+        games.append((game_id, G, V, archive, deadline))
+
+    for game_id, G, V, archive, deadline in games:
+        games_manager.votes_archive[game_id] = archive
+        games_manager.games[game_id] = (G, V)
+        games_manager.index_game(game_id)
+        if deadline:
+            games_manager.queue.schedule(game_id, deadline)
+    games_manager.new_id = new_id
+    return count
+
+
+def benchmark(games : int = 200, moves : int = 120):
+    """
+    Compares restoring games from a snapshot against GameManager.load_game's PGN parsing,
+    measured on random games played to the given length
+    """
+    import io
+    import random
+    import time
+    import chess.pgn
+    from games_manager import GameManager
+
+    boards = []
+    for _ in range(games):
+        board = chess.Board()
+        while len(board.move_stack) < moves and not board.is_game_over():
+            board.push(random.choice(list(board.legal_moves)))
+        boards.append(board)
+
+    manager = GameManager()
+    for game_id, board in enumerate(boards):
+        P = Parameters.Parameters()
+        P.new(datetime.now(), 60, True)
+        G = game.Game(game_id, P, "creator", "password", last_move=datetime.now())
+        for move in board.move_stack:
+            G.make_move_push(move)
+        V = voting_system.Voter()
+        V.new(G.get_legal_moves_uci())
+        manager.games[game_id] = (G, V)
+        manager.votes_archive[game_id] = [{move.uci(): 1} for move in board.move_stack]
+
+    start = time.perf_counter()
+    data = encode_games(manager)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    decode_games(GameManager(), data)
+    decode_time = time.perf_counter() - start
+
+    pgns = [str(chess.pgn.Game.from_board(board)) for board in boards]
+    start = time.perf_counter()
+    for pgn in pgns:
+        G = game.Game(0, Parameters.Parameters())
+        for move in chess.pgn.read_game(io.StringIO(pgn)).mainline_moves():
+            G.make_move_push(move)
+        V = voting_system.Voter()
+        V.new(G.get_legal_moves_uci())
+    pgn_time = time.perf_counter() - start
+
+    print(f"{games} games of {moves} moves: snapshot {len(data)} bytes, encode {encode_time * 1000:.1f} ms, "
+          f"decode {decode_time * 1000:.1f} ms, PGN replay {pgn_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,37 @@
+class SubscriptionRegistry:
+    """
+    Keeps track of which clients receive pushed updates of which games,
+    a client is subscribed to every game its account has joined
+    """
+    def __init__(self):
+        self.__subscribers : dict[int, set[int]] = dict()  # game_id -> client ids
+        self.__subscriptions : dict[int, set[int]] = dict()  # client id -> game ids
+
+    def sync(self, client_id : int, game_ids):
+        """
+        subscribes client to given games and unsubscribes it from the others,
+        cheap when nothing has changed since games of an account are only ever added
+        """
+        current = self.__subscriptions.setdefault(client_id, set())
+        if len(current) == len(game_ids):
+            return
+        game_ids = set(game_ids)
+        for game_id in current - game_ids:
+            self.__unsubscribe(client_id, game_id)
+        for game_id in game_ids - current:
+            self.__subscribers.setdefault(game_id, set()).add(client_id)
+        self.__subscriptions[client_id] = game_ids
+
+    def remove(self, client_id : int):
+        for game_id in self.__subscriptions.pop(client_id, set()):
+            self.__unsubscribe(client_id, game_id)
+
+    def subscribers(self, game_id : int) -> set[int]:
+        return self.__subscribers.get(game_id, set())
+
+    def __unsubscribe(self, client_id : int, game_id : int):
+        subscribers = self.__subscribers.get(game_id)
+        if subscribers is not None:
+            subscribers.discard(client_id)
+            if not subscribers:
+                del self.__subscribers[game_id]
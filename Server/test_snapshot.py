@@ -0,0 +1,99 @@
+import random
+import struct
+from datetime import datetime
+
+import chess
+import Parameters
+import game
+import snapshot
+import voting_system
+from games_manager import GameManager
+
+
+def make_manager(games, voters=True, seed=17):
+    """manager with random games in progress, their votes, archives and deadlines"""
+    rng = random.Random(seed)
+    manager = GameManager()
+    for game_id in range(1, games + 1):
+        P = Parameters.Parameters()
+        P.new(datetime.fromtimestamp(1_700_000_000), 60, False)
+        G = game.Game(game_id, P, "creator", "pass;word", last_move=datetime.fromtimestamp(1_700_000_100))
+        G.load({"w1", "w2"}, {"b1"})
+        for _ in range(rng.randint(0, 30)):
+            if G.board.is_game_over():
+                break
+            G.make_move_push(rng.choice(list(G.board.legal_moves)))
+        V = voting_system.Voter()
+        V.new(G.get_legal_moves_uci())
+        moves = list(V.votes())
+        for _ in range(rng.randint(0, 10)):
+            V.vote(rng.choice(moves), rng.choice(["w1", "w2", "b1", None]) if voters else None)
+        manager.games[game_id] = (G, V)
+        manager.votes_archive[game_id] = [{move.uci(): rng.randint(1, 5)} for move in G.board.move_stack]
+        manager.index_game(game_id)
+        manager.queue.schedule(game_id, 1_700_000_000 + game_id * 60)
+    manager.new_id = games + 1
+    return manager
+
+
+def assert_same_games(expected, restored):
+    assert restored.new_id == expected.new_id
+    assert restored.games.keys() == expected.games.keys()
+    for game_id, (G, V) in expected.games.items():
+        R, W = restored.games[game_id]
+        assert R.get_fen() == G.get_fen()
+        assert R.board.move_stack == G.board.move_stack
+        assert (R.white, R.black) == (G.white, G.black)
+        assert W.votes() == V.votes()
+        assert W.winner() == V.winner()
+        assert restored.votes_archive[game_id] == expected.votes_archive[game_id]
+        assert restored.queue.deadline(game_id) == expected.queue.deadline(game_id)
+        assert restored.players(game_id) == expected.players(game_id)
+
+
+def test_round_trip():
+    manager = make_manager(8)
+    restored = GameManager()
+    assert snapshot.decode_games(restored, snapshot.encode_games(manager)) == 8
+    assert_same_games(manager, restored)
+    for game_id, (G, V) in manager.games.items():
+        assert restored.games[game_id][1].ledger() == V.ledger()
+
+
+def test_version_1_is_read_without_voters():
+    # version 1 is version 2 without the voters count closing every game, here the only game has none
+    manager = make_manager(1, voters=False)
+    data = snapshot.encode_games(manager)
+    magic, _, new_id, count = snapshot.FILE_HEADER.unpack_from(data)
+    assert data[-4:] == struct.pack("!I", 0)
+    v1 = snapshot.FILE_HEADER.pack(magic, 1, new_id, count) + data[snapshot.FILE_HEADER.size:-4]
+    restored = GameManager()
+    assert snapshot.decode_games(restored, v1) == 1
+    assert_same_games(manager, restored)
+    assert restored.games[1][1].ledger() == {}
+
+
+def test_truncated_snapshot_changes_nothing():
+    data = snapshot.encode_games(make_manager(3))
+    restored = GameManager()
+    try:
+        snapshot.decode_games(restored, data[:-7])
+    except Exception:
+        pass
+    else:
+        assert False, "truncated snapshot was decoded"
+    assert restored.games == {} and restored.queue.next_deadline() is None
+
+
+def test_moves_pack():
+    board = chess.Board("8/P7/8/8/8/8/7k/K7 w - - 0 1")
+    for move in board.legal_moves:
+        assert snapshot.unpack_move(snapshot.pack_move(move)) == move
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_version_1_is_read_without_voters()
+    test_truncated_snapshot_changes_nothing()
+    test_moves_pack()
+    print("[Info]: snapshot tests passed")
@@ -0,0 +1,82 @@
+import random
+
+from voting_system import Voter
+
+
+MOVES = ["e2e4", "d2d4", "g1f3", "c2c4", "b1c3"]
+
+
+def recount(ballots):
+    """naive tally of (voter, move) ballots, a voter's last ballot counts, anonymous (None) ones all count"""
+    votes = dict.fromkeys(MOVES, 0)
+    ledger = dict()
+    for voter, move in ballots:
+        if voter is None:
+            votes[move] += 1
+        else:
+            ledger[voter] = move
+    for move in ledger.values():
+        votes[move] += 1
+    return votes, ledger
+
+
+def naive_winner(votes):
+    most = max(votes.values())
+    leaders = [move for move, count in votes.items() if count == most]
+    return leaders[0] if len(leaders) == 1 else None
+
+
+def random_ballots(rng, count, voters):
+    return [(rng.choice([None] + [f"user{i}" for i in range(voters)]), rng.choice(MOVES)) for _ in range(count)]
+
+
+def test_tally_matches_recount():
+    rng = random.Random(20)
+    for _ in range(300):
+        ballots = random_ballots(rng, rng.randint(0, 40), rng.randint(1, 6))
+        V = Voter()
+        V.new(MOVES)
+        for i, (voter, move) in enumerate(ballots):
+            V.vote(move, voter)
+            votes, ledger = recount(ballots[:i + 1])
+            assert V.votes() == votes
+            assert V.ledger() == ledger
+            assert V.winner() == naive_winner(votes)
+
+
+def test_load_continues_tally():
+    rng = random.Random(21)
+    for _ in range(100):
+        before = random_ballots(rng, rng.randint(0, 20), 4)
+        after = random_ballots(rng, rng.randint(0, 20), 4)
+        V = Voter()
+        V.new(MOVES)
+        for voter, move in before:
+            V.vote(move, voter)
+        loaded = Voter()
+        loaded.load(V.votes(), V.ledger())
+        for voter, move in after:
+            loaded.vote(move, voter)
+        votes, ledger = recount(before + after)
+        assert loaded.votes() == votes
+        assert loaded.ledger() == ledger
+        assert loaded.winner() == naive_winner(votes)
+
+
+def test_illegal_move_is_rejected():
+    V = Voter()
+    V.new(MOVES)
+    try:
+        V.vote("e2e5", "user0")
+    except Exception:
+        pass
+    else:
+        assert False, "illegal move was counted"
+    assert V.ledger() == {} and sum(V.votes().values()) == 0
+
+
+if __name__ == "__main__":
+    test_tally_matches_recount()
+    test_load_continues_tally()
+    test_illegal_move_is_rejected()
+    print("[Info]: voting_system tests passed")
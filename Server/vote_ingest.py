@@ -0,0 +1,174 @@
+import multiprocessing
+import os
+import time
+
+import voting_system
+
+
+# votes buffered per worker before they are sent in one message
+BATCH_SIZE = 512
+STOP_WORKER = None
+
+
+def run_worker(conn):
+    """
+    Worker process keeping partial tallies of crowd games, one Voter per game,
+    it counts only the voters routed to it, so its ledger is the only one that knows them
+    """
+    partials : dict[int, voting_system.Voter] = dict()
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is STOP_WORKER:
+            break
+        operation, args = request
+        try:
+            match operation:
+                case "new":
+                    game_id, moves = args
+                    partials[game_id] = V = voting_system.Voter()
+                    V.new(moves)
+                case "votes":
+                    # moves were validated by the front-end, a game dropped meanwhile is skipped
+                    for game_id, move, voter in args[0]:
+                        if (V := partials.get(game_id)) is not None:
+                            V.vote(move, voter)
+                case "tally":
+                    game_id, = args
+                    V = partials.get(game_id)
+                    conn.send((True, (dict(V.votes()), dict(V.ledger())) if V is not None else ({}, {})))
+                case "drop":
+                    game_id, = args
+                    partials.pop(game_id, None)
+                case _:
+                    raise Exception(f"unknown operation {operation}")
+        except Exception as e:
+            print(f"[Exception] run_worker(): {e}")
+            if operation == "tally":
+                conn.send((False, str(e)))
+    conn.close()
+
+
+class VoteIngestor:
+    """
+    Counts votes of crowd games in worker processes, each holding a partial tally,
+    voters are routed to workers by hash of their login, so a changed vote replaces the earlier one
+    in the same worker and partial tallies merge by adding counts up;
+    votes are sent to workers in batches and merged into the game's Voter at its deadline
+    """
+    def __init__(self, workers : int|None = None, batch_size : int = BATCH_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.__buffers : list[list[tuple]] = [[] for _ in range(self.workers)]
+        self.__conns = []
+        self.__processes = []
+        for _ in range(self.workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker, args=(worker_conn,), daemon=True)
+            process.start()
+            worker_conn.close()
+            self.__conns.append(conn)
+            self.__processes.append(process)
+        print(f"[Info]: Started {self.workers} vote workers")
+
+    def new(self, game_id : int, moves):
+        """starts tallies of the next move of a game, partial votes of the previous one are discarded"""
+        self.flush()
+        moves = list(moves)
+        for conn in self.__conns:
+            conn.send(("new", (game_id, moves)))
+
+    def vote(self, game_id : int, move : str, voter = None):
+        worker = hash(voter) % self.workers
+        buffer = self.__buffers[worker]
+        buffer.append((game_id, move, voter))
+        if len(buffer) >= self.batch_size:
+            self.__conns[worker].send(("votes", (buffer,)))
+            self.__buffers[worker] = []
+
+    def flush(self):
+        for worker, buffer in enumerate(self.__buffers):
+            if buffer:
+                self.__conns[worker].send(("votes", (buffer,)))
+                self.__buffers[worker] = []
+
+    def tally(self, game_id : int) -> tuple[dict[str, int], dict]:
+        """
+        merges partial tallies of a game, workers keep theirs, so it can be called again
+        :return: (move -> votes, voter -> move), as taken by Voter.load
+        """
+        self.flush()
+        for conn in self.__conns:
+            conn.send(("tally", (game_id,)))
+        votes, ledger = dict(), dict()
+        for conn in self.__conns:
+            ok, result = conn.recv()
+            if not ok:
+                raise Exception(result)
+            partial_votes, partial_ledger = result
+            for move, count in partial_votes.items():
+                votes[move] = votes.get(move, 0) + count
+            ledger.update(partial_ledger)
+        return votes, ledger
+
+    def drop(self, game_id : int):
+        self.flush()
+        for conn in self.__conns:
+            conn.send(("drop", (game_id,)))
+
+    def close(self):
+        for conn in self.__conns:
+            try:
+                conn.send(STOP_WORKER)
+            except Exception:
+                pass
+        for process in self.__processes:
+            process.join(1)
+        for conn in self.__conns:
+            conn.close()
+        self.__conns = []
+        self.__processes = []
+
+
+def benchmark(voters : int = 20_000, ballots : int = 1_000_000, moves : int = 35):
+    """
+    Sustained votes per second on a single game, counted by one Voter on the calling thread
+    and by VoteIngestor with a growing number of workers, including the merge at the deadline
+    """
+    import random
+
+    move_list = [f"m{i}" for i in range(moves)]
+    logins = [f"user{i}" for i in range(voters)]
+    stream = [(random.choice(logins), random.choice(move_list)) for _ in range(ballots)]
+
+    V = voting_system.Voter()
+    V.new(move_list)
+    start = time.perf_counter()
+    for voter, move in stream:
+        V.vote(move, voter)
+    V.winner()
+    elapsed = time.perf_counter() - start
+    print(f"single Voter: {ballots / elapsed:12.0f} votes/s")
+    expected = V.votes()
+
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        ingestor = VoteIngestor(workers)
+        ingestor.new(0, move_list)
+        start = time.perf_counter()
+        for voter, move in stream:
+            ingestor.vote(0, move, voter)
+        votes, ledger = ingestor.tally(0)
+        V = voting_system.Voter()
+        V.load(votes, ledger)
+        V.winner()
+        elapsed = time.perf_counter() - start
+        ingestor.close()
+        assert votes == expected
+        print(f"{workers} workers: {ballots / elapsed:12.0f} votes/s")
+    print(f"{os.cpu_count()} cores available")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -1,24 +1,140 @@
-
-import database
+import random
+import time
 
 
 class Voter:
+    """
+    Tally of votes on moves of one position, counts and the set of leading moves
+    are maintained on every ballot, so casting, changing a vote and finding the winner are O(1);
+    ledger remembers each voter's ballot so a changed vote moves it instead of adding a second one
+    """
     def __init__(self):
-        self.vote_counter = dict()
+        self.vote_counter = dict()  # move -> number of votes
+        self.__by_count : dict[int, set[str]] = dict()  # number of votes -> moves having it
+        self.__max_count = 0
+        self.__ledger : dict = dict()  # voter -> move
 
     def new(self, move_list):
-        self.vote_counter = dict()
+        self.vote_counter = dict.fromkeys(move_list, 0)
+        self.__by_count = {0: set(self.vote_counter)}
+        self.__max_count = 0
+        self.__ledger = dict()
 
-        for move in move_list:
-            self.vote_counter.update({move: 0})
+    def load(self, vote_counter, ledger=None):
+        """restores tally of votes already cast, e.g. from a snapshot"""
+        self.vote_counter = dict(vote_counter)
+        self.__by_count = dict()
+        for move, count in self.vote_counter.items():
+            self.__by_count.setdefault(count, set()).add(move)
+        self.__max_count = max(self.__by_count, default=0)
+        self.__ledger = dict(ledger or {})
+
+    def vote(self, vote, voter=None):
+        """
+        :param voter: identity of the voter, e.g. login, their previous ballot is moved to this vote,
+            anonymous ballots are always added
+        """
+        if vote not in self.vote_counter:
+            raise Exception(f"illegal move {vote}")
+        if voter is not None:
+            previous = self.__ledger.get(voter)
+            if previous == vote:
+                return
+            if previous is not None:
+                self.__move(previous, -1)
+            self.__ledger[voter] = vote
 
-    def vote(self, vote):
+        # increment inlined, it is the hot path
+        by_count = self.__by_count
+        count = self.vote_counter[vote]
+        moves = by_count[count]
+        moves.discard(vote)
+        if not moves:
+            del by_count[count]
+        count += 1
+        self.vote_counter[vote] = count
+        if count in by_count:
+            by_count[count].add(vote)
+        else:
+            by_count[count] = {vote}
+        if count > self.__max_count:
+            self.__max_count = count
 
-        self.vote_counter.update({vote: self.vote_counter.get(vote) + 1})
+    def __move(self, move, delta):
+        count = self.vote_counter[move]
+        moves = self.__by_count[count]
+        moves.discard(move)
+        if not moves:
+            del self.__by_count[count]
+        count += delta
+        self.vote_counter[move] = count
+        self.__by_count.setdefault(count, set()).add(move)
+        if count > self.__max_count:
+            self.__max_count = count
+        elif count + 1 == self.__max_count and self.__max_count not in self.__by_count:
+            self.__max_count = count
 
     def votes(self):
         return self.vote_counter
 
+    def ledger(self):
+        return self.__ledger
+
     def get_most_vote(self):
-        return [key for key, value in self.vote_counter.items() if value == max(self.vote_counter.values())]
+        return list(self.__by_count.get(self.__max_count, ()))
+
+    def winner(self):
+        """returns the only move with most votes, None if there is a tie or no moves"""
+        leaders = self.__by_count.get(self.__max_count, ())
+        if len(leaders) != 1:
+            return None
+        return next(iter(leaders))
+
+
+def benchmark(voters : int = 5000, moves : int = 35, changes : float = 0.2, rounds : int = 20):
+    """
+    Compares Voter against the former tally, a dict updated per ballot and
+    max of values recomputed for every move on resolution, with voters changing their mind
+    """
+    move_list = [f"m{i}" for i in range(moves)]
+    ballots = [(voter, random.choice(move_list)) for voter in range(voters)]
+    ballots += [(random.randrange(voters), random.choice(move_list)) for _ in range(int(voters * changes))]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        V = Voter()
+        V.new(move_list)
+        for voter, move in ballots:
+            V.vote(move, voter)
+        V.winner()
+    elapsed = time.perf_counter() - start
+    print(f"Voter, {voters} voters: {rounds * len(ballots) / elapsed:12.0f} ballots/s, {elapsed / rounds * 1000:8.2f} ms/round")
+
+    # baseline, every ballot counts, even repeated ones of the same voter
+    start = time.perf_counter()
+    for _ in range(rounds):
+        vote_counter = dict()
+        for move in move_list:
+            vote_counter.update({move: 0})
+        for voter, move in ballots:
+            vote_counter.update({move: vote_counter.get(move) + 1})
+        [key for key, value in vote_counter.items() if value == max(vote_counter.values())]
+    elapsed = time.perf_counter() - start
+    print(f"dict tally, {voters} voters: {rounds * len(ballots) / elapsed:12.0f} ballots/s, {elapsed / rounds * 1000:8.2f} ms/round")
+
+    # resolution alone, on a position with many legal moves
+    V = Voter()
+    V.new([f"m{i}" for i in range(200)])
+    start = time.perf_counter()
+    for _ in range(10_000):
+        V.winner()
+    winner_time = (time.perf_counter() - start) / 10_000
+    start = time.perf_counter()
+    for _ in range(1_000):
+        [key for key, value in V.vote_counter.items() if value == max(V.vote_counter.values())]
+    scan_time = (time.perf_counter() - start) / 1_000
+    print(f"resolution with 200 moves: winner {winner_time * 1e6:8.2f} us, max scan {scan_time * 1e6:8.2f} us")
+
 
+if __name__ == "__main__":
+    benchmark()
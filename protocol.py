@@ -1,10 +1,35 @@
+import asyncio
 import socket
+import struct
+import time
+import zlib
+import json
 import utility
+from collections import Counter, deque
+from itertools import chain, islice
 
 
 FORMAT = 'utf-8'
 HEADER_SIZE = 128
 TIMEOUT = 0.5
+RECV_SIZE = 65536
+IOV_MAX = 64  # max buffers passed to a single sendmsg call
+
+# framing modes, legacy is the space padded ASCII header of HEADER_SIZE bytes,
+# compact is a 4 byte big endian length prefix negotiated with HELLO_MSG,
+# compact zlib additionally compresses bodies of at least COMPRESSION_THRESHOLD bytes
+FRAMING_LEGACY = 0
+FRAMING_COMPACT = 1
+FRAMING_COMPACT_ZLIB = 2
+COMPACT_HEADER = struct.Struct("!I")
+
+# highest bit of compact header marks compressed body
+COMPRESSED_FLAG = 0x80000000
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+# longest body a header may declare, so a peer can't make the receiver buffer without bound
+MAX_FRAME_SIZE = 1024 * 1024
 
 SERVER_ID = b"\x02"
 CLIENT_ID = b"\x04"
@@ -18,6 +43,241 @@ CONSOLE_DSC_MSG = "<>"
 CLIENT_DSC_MSG = "><"
 SHUTDOWN_MSG = "exit"
 
+# sent instead of client ID when server doesn't accept more connections
+SERVER_FULL_MSG = "full"
+# failure message of commands rejected by rate limiting
+RATE_LIMITED_MSG = "Rate limit exceeded"
+
+# capabilities handshake: client sends "hello <capability>..." in legacy framing,
+# server answers with SERVER_ID byte followed by legacy "hello <accepted>..." message,
+# servers that don't know the handshake answer with a bare CONFIRMATION_BYTE
+HELLO_MSG = "hello"
+CAP_COMPACT = "compact"
+CAP_TAGGED = "tagged"
+CAP_ZLIB = "zlib"
+CAP_PUSH = "push"
+CAP_SESSION = "session"
+CAPABILITIES = (CAP_COMPACT, CAP_TAGGED, CAP_ZLIB, CAP_PUSH, CAP_SESSION)
+
+# clients with CAP_PUSH receive "{}<game_id> <seq> <move> <fen>" whenever a move is made in game they joined,
+# seq being number of moves made in the game so far
+UPDATE_PREFIX = "{}"
+
+# "rf <game_id> <since_seq>" is answered with "[=]<seq>" if no move was made since since_seq,
+# "[+]<seq> <move>..." with moves made since then, or full FEN_PREFIX message if since_seq is not valid
+NOT_MODIFIED_PREFIX = "[=]"
+DELTA_PREFIX = "[+]"
+
+# clients with CAP_SESSION receive "()<token>" after logging in,
+# "resume <token>" on a new connection restores the session without logging in again
+SESSION_PREFIX = "()"
+RESUME_MSG = "resume"
+
+# tagged requests "#<request_id> <command>" are answered with single message
+# "#<request_id> ok|fail [message]" instead of confirmation/failure byte,
+# so many requests can be in flight and replies matched out of order
+REQUEST_PREFIX = "#"
+REPLY_OK = "ok"
+REPLY_FAIL = "fail"
+
+# "batch <command>;<command>;..." carries many commands in one frame,
+# it is answered with one reply whose message is "ok|fail [message]" of every command
+BATCH_MSG = "batch"
+BATCH_SEPARATOR = ";"
+# batches with more commands are refused as a whole
+MAX_BATCH_SIZE = 64
+BATCH_TOO_LARGE_MSG = "Batch too large"
+
+# what OutboundQueue does with a message that doesn't fit into its bound,
+# drop discards it, coalesce replaces queued message with the same key by it
+# and disconnect closes the connection; messages without key always disconnect
+OVERFLOW_DROP = "drop"
+OVERFLOW_COALESCE = "coalesce"
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_COALESCE, OVERFLOW_DISCONNECT)
+OUTBOUND_MAX_SIZE = 256 * 1024
+
+
+def accept_capabilities(capabilities, supported=CAPABILITIES) -> list[str]:
+    """
+    Returns capabilities of client's hello the server grants, CAP_PUSH only together with CAP_TAGGED,
+    untagged replies are a byte and a message, an update must not arrive between them
+    """
+    accepted = [cap for cap in capabilities if cap in supported]
+    if CAP_TAGGED not in accepted:
+        accepted = [cap for cap in accepted if cap != CAP_PUSH]
+    return accepted
+
+
+def framing_for(capabilities) -> int:
+    """Returns framing mode that should be used with peer of given capabilities"""
+    if CAP_COMPACT not in capabilities:
+        return FRAMING_LEGACY
+    return FRAMING_COMPACT_ZLIB if CAP_ZLIB in capabilities else FRAMING_COMPACT
+
+
+def tag_msg(request_id : int, msg : str) -> str:
+    return f"{REQUEST_PREFIX}{request_id} {msg}"
+
+
+def untag_msg(msg : str) -> tuple[int|None, str]:
+    """
+    Splits tagged message into its request id and command,
+    returns (None, msg) if message is not tagged
+    """
+    if not msg.startswith(REQUEST_PREFIX):
+        return None, msg
+    tag, _, rest = msg[len(REQUEST_PREFIX):].partition(" ")
+    if (request_id := utility.silent_apply(tag, int)) is None:
+        return None, msg
+    return request_id, rest
+
+
+def make_reply(request_id : int, ok : bool, msg : str|None = None) -> str:
+    reply = tag_msg(request_id, REPLY_OK if ok else REPLY_FAIL)
+    return reply if msg is None else f"{reply} {msg}"
+
+
+def parse_reply(msg : str) -> tuple[int, bool, str|None]|None:
+    """
+    Returns (request_id, success, optional message) of tagged reply,
+    or None if message is not a reply
+    """
+    request_id, rest = untag_msg(msg)
+    if request_id is None:
+        return None
+    status, _, payload = rest.partition(" ")
+    if status not in (REPLY_OK, REPLY_FAIL):
+        return None
+    return request_id, status == REPLY_OK, payload if payload else None
+
+
+def make_update(game_id : int, seq : int, move : str, fen : str) -> str:
+    return f"{UPDATE_PREFIX}{game_id} {seq} {move} {fen}"
+
+
+def parse_update(msg : str) -> tuple[int, int, str, str]|None:
+    """Returns (game_id, seq, move, fen) of pushed update, or None if message is not an update"""
+    if not msg.startswith(UPDATE_PREFIX):
+        return None
+    game_id, seq, move, fen = (msg[len(UPDATE_PREFIX):].split(" ", 3) + [""] * 3)[:4]
+    if (args := utility.silent_convert((game_id, int), (seq, int))) is None:
+        return None
+    return *args, move, fen
+
+
+def make_session(token : str) -> str:
+    return f"{SESSION_PREFIX}{token}"
+
+
+def parse_session(msg : str) -> str|None:
+    """Returns session token, or None if message doesn't carry one"""
+    if not msg.startswith(SESSION_PREFIX):
+        return None
+    return msg[len(SESSION_PREFIX):].strip() or None
+
+
+def make_delta(seq : int, moves : list[str]) -> str:
+    if not moves:
+        return f"{NOT_MODIFIED_PREFIX}{seq}"
+    return f"{DELTA_PREFIX}{seq} " + " ".join(moves)
+
+
+def parse_delta(msg : str) -> tuple[int, list[str]]|None:
+    """
+    Returns (seq, moves made since requested seq) of answer to conditional refresh,
+    or None if message is neither delta nor not modified answer
+    """
+    for prefix in (NOT_MODIFIED_PREFIX, DELTA_PREFIX):
+        if msg.startswith(prefix):
+            seq, *moves = msg[len(prefix):].split()
+            if (seq := utility.silent_apply(seq, int)) is None:
+                return None
+            return seq, moves
+    return None
+
+
+def make_batch(commands : list[str]) -> str:
+    """
+    Returns batch message carrying commands, separator is not escaped,
+    so a command containing it, e.g. join with such game password, has to be sent on its own
+    """
+    if any(BATCH_SEPARATOR in cmd for cmd in commands):
+        raise ValueError(f"command in batch can't contain '{BATCH_SEPARATOR}'")
+    return f"{BATCH_MSG} " + BATCH_SEPARATOR.join(commands)
+
+
+def split_batch(msg : str) -> list[str]:
+    """Returns commands carried by batch message, without BATCH_MSG prefix"""
+    _, _, body = msg.strip().partition(" ")
+    return [cmd.strip() for cmd in body.split(BATCH_SEPARATOR) if cmd.strip()]
+
+
+def make_batch_reply(results : list[tuple[bool, str|None]]) -> str:
+    return BATCH_SEPARATOR.join((REPLY_OK if ok else REPLY_FAIL) + ("" if msg is None else f" {msg}") for ok, msg in results)
+
+
+def parse_batch_reply(msg : str) -> list[tuple[bool, str|None]]:
+    """Returns (success, optional message) of every command of batch, in order"""
+    results = []
+    for result in msg.split(BATCH_SEPARATOR):
+        status, _, payload = result.partition(" ")
+        results.append((status == REPLY_OK, payload if payload else None))
+    return results
+
+
+def encode_header(length : int, framing : int = FRAMING_LEGACY) -> bytes:
+    """Returns header of message with body of given length"""
+    if framing != FRAMING_LEGACY:
+        return COMPACT_HEADER.pack(length)
+    bheader = str(length).encode(FORMAT)
+    return bheader + b' ' * (HEADER_SIZE - len(bheader))
+
+
+def encode_frame(msg : str, framing : int = FRAMING_LEGACY) -> tuple[bytes, bytes]:
+    """
+    Returns header and body of message,
+    body is compressed only if framing allows it and message is large enough
+    """
+    bmsg = msg.encode(FORMAT)
+    if framing == FRAMING_COMPACT_ZLIB and len(bmsg) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(bmsg, COMPRESSION_LEVEL)
+        if len(compressed) < len(bmsg):
+            return COMPACT_HEADER.pack(len(compressed) | COMPRESSED_FLAG), compressed
+    return encode_header(len(bmsg), framing), bmsg
+
+
+def header_size(framing : int = FRAMING_LEGACY) -> int:
+    return COMPACT_HEADER.size if framing != FRAMING_LEGACY else HEADER_SIZE
+
+
+def decode_header(bheader : bytes, framing : int = FRAMING_LEGACY) -> tuple[int, bool]:
+    """
+    Returns length of message body described by header and whether the body is compressed,
+    raises ValueError if header is malformed or declares body longer than MAX_FRAME_SIZE
+    """
+    if framing != FRAMING_LEGACY:
+        value = COMPACT_HEADER.unpack(bheader)[0]
+        length, compressed = value & ~COMPRESSED_FLAG, bool(value & COMPRESSED_FLAG)
+    else:
+        length, compressed = int(bheader.decode(FORMAT)), False
+    if not 0 <= length <= MAX_FRAME_SIZE:
+        raise ValueError(f"frame body of {length} bytes")
+    return length, compressed
+
+
+def decode_body(bmsg : bytes, compressed : bool = False) -> str:
+    """Returns message carried by body, raises ValueError if compressed body is malformed"""
+    if compressed:
+        try:
+            decompressor = zlib.decompressobj()
+            bmsg = decompressor.decompress(bmsg, MAX_DECOMPRESSED_SIZE)
+        except zlib.error as e:
+            raise ValueError(e)
+        if decompressor.unconsumed_tail:
+            raise ValueError("decompressed message too long")
+    return bmsg.decode(FORMAT)
+
 
 def send_byte(sock : socket.socket, byte : bytes, verbose : bool = True) -> bool:
     """
@@ -56,17 +316,14 @@ def recv_byte(sock : socket.socket, verbose : bool = True) -> bytes|None:
 
 
 
-def send_msg(sock : socket.socket, msg : str, verbose : bool = True) -> bool:
+def send_msg(sock : socket.socket, msg : str, verbose : bool = True, framing : int = FRAMING_LEGACY) -> bool:
     """
     Tries to send string message using provided socket,
     returns False if any exception has occured;
     if verbose is True, will print what type of exception has occured
     """
     try:
-        bmsg = msg.encode(FORMAT)
-        bmsg_length = len(bmsg)
-        bheader = str(bmsg_length).encode(FORMAT)
-        bheader += b' ' * (HEADER_SIZE - len(bheader))
+        bheader, bmsg = encode_frame(msg, framing)
 
         sent = 0
         while bheader:
@@ -88,7 +345,7 @@ def send_msg(sock : socket.socket, msg : str, verbose : bool = True) -> bool:
 
 
 
-def recv_msg(sock : socket.socket, verbose : bool = True) -> str|None:
+def recv_msg(sock : socket.socket, verbose : bool = True, framing : int = FRAMING_LEGACY) -> str|None:
     """
     Tries to receive string message using provided socket,
     returns message received or None if any exception has occured;
@@ -97,20 +354,21 @@ def recv_msg(sock : socket.socket, verbose : bool = True) -> str|None:
     try:
         msg = None
         bheader = b''
-        while len(bheader) != HEADER_SIZE:
-            recv = sock.recv(HEADER_SIZE - len(bheader))
+        size = header_size(framing)
+        while len(bheader) != size:
+            recv = sock.recv(size - len(bheader))
             if recv == b'':
                 return None
             bheader += recv
         
-        bmsg_length = int(bheader.decode(FORMAT))
+        bmsg_length, compressed = decode_header(bheader, framing)
         bmsg = b''
         while len(bmsg) != bmsg_length:
             recv = sock.recv(bmsg_length - len(bmsg))
             if recv == b'':
                 return None
             bmsg += recv
-        msg = bmsg.decode(FORMAT)
+        msg = decode_body(bmsg, compressed)
         return msg
     
     except Exception as e:
@@ -119,6 +377,199 @@ def recv_msg(sock : socket.socket, verbose : bool = True) -> str|None:
         return None
 
 
+async def async_send_byte(writer : asyncio.StreamWriter, byte : bytes, verbose : bool = True) -> bool:
+    """asyncio version of send_byte"""
+    assert len(byte) == 1
+    try:
+        writer.write(byte)
+        await writer.drain()
+        return True
+    except Exception as e:
+        if verbose:
+            print(f"[Exception] async_send_byte(): {e}")
+        return False
+
+
+async def async_send_msg(writer : asyncio.StreamWriter, msg : str, verbose : bool = True, framing : int = FRAMING_LEGACY) -> bool:
+    """asyncio version of send_msg, waits until writer's buffer drains below its limit"""
+    try:
+        writer.writelines(encode_frame(msg, framing))
+        await writer.drain()
+        return True
+    except Exception as e:
+        if verbose:
+            print(f"[Exception] async_send_msg(): {e}")
+        return False
+
+
+async def async_recv_msg(reader : asyncio.StreamReader, verbose : bool = True, framing : int = FRAMING_LEGACY) -> str|None:
+    """asyncio version of recv_msg, returns None if connection was closed or any exception has occured"""
+    try:
+        bheader = await reader.readexactly(header_size(framing))
+        bmsg_length, compressed = decode_header(bheader, framing)
+        bmsg = await reader.readexactly(bmsg_length)
+        return decode_body(bmsg, compressed)
+    except asyncio.IncompleteReadError:
+        return None
+    except Exception as e:
+        if verbose:
+            print(f"[Exception] async_recv_msg(): {e}")
+        return None
+
+
+class FrameDecoder:
+    """
+    Incremental decoder of framed messages for selector driven sockets,
+    it is fed with whatever bytes are available and never blocks,
+    partial headers and bodies are buffered until the rest arrives
+    """
+    def __init__(self, framing : int = FRAMING_LEGACY):
+        self.framing : int = framing
+        self.__buffer : bytearray = bytearray()
+        self.__body_length : int|None = None
+        self.__compressed : bool = False
+
+    def feed(self, data : bytes):
+        self.__buffer += data
+
+    def next_msg(self) -> str|None:
+        """
+        Returns next complete message or None if it has not fully arrived yet,
+        raises ValueError if header is malformed
+        """
+        if self.__body_length is None:
+            size = header_size(self.framing)
+            if len(self.__buffer) < size:
+                return None
+            self.__body_length, self.__compressed = decode_header(bytes(self.__buffer[:size]), self.framing)
+            del self.__buffer[:size]
+
+        if len(self.__buffer) < self.__body_length:
+            return None
+        bmsg = bytes(self.__buffer[:self.__body_length])
+        del self.__buffer[:self.__body_length]
+        self.__body_length = None
+        return decode_body(bmsg, self.__compressed)
+
+    def __iter__(self):
+        # framing is checked before every message, so it can be switched in between
+        while (msg := self.next_msg()) is not None:
+            yield msg
+
+
+def recv_into(sock : socket.socket, decoder : FrameDecoder, verbose : bool = True) -> int:
+    """
+    Receives bytes that are already available on the socket and feeds them to decoder,
+    should be called only when selector reports socket as readable;
+    returns number of bytes received, 0 if connection was closed or any exception has occured
+    """
+    try:
+        data = sock.recv(RECV_SIZE)
+        decoder.feed(data)
+        return len(data)
+    except Exception as e:
+        if verbose:
+            print(f"[Exception] recv_into(): {e}")
+        return 0
+
+
+class OutboundQueue:
+    """
+    Bounded queue of outgoing data of a non-blocking connection,
+    header and body are written together with scatter-gather sendmsg,
+    partially sent buffers are advanced with memoryview offsets instead of being copied;
+    when a message doesn't fit into max_size pending bytes the overflow policy decides its fate
+    and counters record how often each policy has triggered
+    """
+    def __init__(self, max_size : int|None = None, overflow : str = OVERFLOW_DISCONNECT, counters : Counter|None = None):
+        self.__frames : deque[list] = deque()  # [key, buffers] of queued messages, buffers of replaced ones are emptied
+        self.__latest : dict = dict()  # key -> its queued frame that hasn't started being sent yet
+        self.size : int = 0  # bytes waiting to be sent
+        self.bytes_sent : int = 0
+        self.max_size : int|None = max_size
+        self.overflow : str = overflow
+        self.counters : Counter = counters if counters is not None else Counter()
+
+    def push(self, *buffers : bytes, key = None) -> bool:
+        """
+        Queues buffers of a single message, key marks messages superseded by newer ones
+        with the same key, e.g. board updates of one game, only those can be dropped or coalesced;
+        returns False if connection should be closed since the message doesn't fit
+        """
+        length = sum(map(len, buffers))
+        if self.max_size is not None and self.size + length > self.max_size:
+            return self.__overflow(buffers, key)
+        self.__append(buffers, key)
+        return True
+
+    def push_msg(self, msg : str, framing : int = FRAMING_LEGACY, key = None) -> bool:
+        return self.push(*encode_frame(msg, framing), key=key)
+
+    def pending(self) -> bool:
+        return self.size != 0
+
+    def __append(self, buffers, key):
+        frame = [key, [memoryview(buffer) for buffer in buffers if buffer]]
+        self.__frames.append(frame)
+        self.size += sum(map(len, frame[1]))
+        if key is not None:
+            self.__latest[key] = frame
+
+    def __overflow(self, buffers, key) -> bool:
+        if key is None or self.overflow == OVERFLOW_DISCONNECT:
+            self.counters[OVERFLOW_DISCONNECT] += 1
+            return False
+        if self.overflow == OVERFLOW_COALESCE and (frame := self.__latest.pop(key, None)) is not None:
+            # older message is emptied in place, it is dropped from the queue once it reaches the head
+            self.size -= sum(map(len, frame[1]))
+            frame[1] = []
+            self.__append(buffers, key)
+            self.counters[OVERFLOW_COALESCE] += 1
+            return True
+        self.counters[OVERFLOW_DROP] += 1
+        return True
+
+    def flush(self, sock : socket.socket, verbose : bool = True) -> bool:
+        """
+        Sends as much as the socket accepts without blocking,
+        returns False if connection was closed or any exception has occured
+        """
+        while self.__frames and not self.__frames[0][1]:
+            self.__frames.popleft()
+        while self.__frames:
+            try:
+                if hasattr(sock, "sendmsg"):
+                    sent = sock.sendmsg(list(islice(chain.from_iterable(buffers for _, buffers in self.__frames), IOV_MAX)))
+                else:
+                    sent = sock.send(self.__frames[0][1][0])
+            except (BlockingIOError, InterruptedError):
+                return True
+            except Exception as e:
+                if verbose:
+                    print(f"[Exception] OutboundQueue.flush(): {e}")
+                return False
+            if sent == 0:
+                return False
+
+            self.size -= sent
+            self.bytes_sent += sent
+            while sent:
+                key, buffers = frame = self.__frames[0]
+                if key is not None and self.__latest.get(key) is frame:
+                    # message is on the wire, it can't be replaced anymore
+                    del self.__latest[key]
+                head = buffers[0]
+                if sent >= len(head):
+                    sent -= len(head)
+                    del buffers[0]
+                else:
+                    buffers[0] = head[sent:]
+                    sent = 0
+                while self.__frames and not self.__frames[0][1]:
+                    self.__frames.popleft()
+        return True
+
+
 def create_listening_socket(host : str, port : int, verbose : bool = True) -> socket.socket|None:
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -138,6 +589,71 @@ def create_socket() -> socket.socket:
     return sock
 
 
+def benchmark_framing(frames : int = 100_000, msg : str = "vote 3 e2e4", burst : int = 100, rounds : int = 5):
+    """
+    Measures frames/sec over a socketpair for every framing mode and prints the best of rounds,
+    modes take turns so that noise hits both alike; bursts of frames are queued in OutboundQueue
+    and flushed with sendmsg, then received and decoded by FrameDecoder, as the server does,
+    so the header size is what differs
+    """
+    modes = (("legacy", FRAMING_LEGACY), ("compact", FRAMING_COMPACT))
+    best = dict.fromkeys([name for name, _ in modes], 0.0)
+    for _ in range(rounds):
+        for name, framing in modes:
+            a, b = socket.socketpair()
+            a.setblocking(False)
+            outbound = OutboundQueue()
+            decoder = FrameDecoder(framing)
+            received = 0
+            try:
+                start = time.perf_counter()
+                for sent in range(burst, frames + burst, burst):
+                    for _ in range(burst):
+                        outbound.push_msg(msg, framing)
+                    while outbound.pending() or received < sent:
+                        outbound.flush(a)
+                        decoder.feed(b.recv(RECV_SIZE))
+                        while decoder.next_msg() is not None:
+                            received += 1
+                best[name] = max(best[name], received / (time.perf_counter() - start))
+            finally:
+                a.close()
+                b.close()
+    for name, framing in modes:
+        frame_size = header_size(framing) + len(msg.encode(FORMAT))
+        print(f"{name:>8}: {best[name]:12.0f} frames/s, {frame_size} bytes/frame")
+
+
+def benchmark_compression(repeat : int = 200):
+    """
+    Measures bytes saved and CPU time spent by compressing typical messages
+    with FRAMING_COMPACT_ZLIB and prints the results
+    """
+    moves = "e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 e1g1 f8e7 f1e1 b7b5 a4b3 d7d6 c2c3 e8g8".split()
+    pgn = "\n".join(f'[Votes_move_{i + 1} "{{\'{move}\': {i % 7 + 1}, \'a2a3\': 0, \'h2h4\': 1}}"]' for i, move in enumerate(moves * 8))
+    pgn += "\n\n" + " ".join(f"{i // 2 + 1}. {move}" if i % 2 == 0 else move for i, move in enumerate(moves * 8))
+    analysis = json.dumps({"data": [{"move_stack": moves * 8,
+                                     "eval_stack": [i * 13 % 200 - 100 for i in range(len(moves) * 8)],
+                                     "best_line_stack": [moves[i % len(moves):] for i in range(len(moves) * 8)]}]})
+    tally = str({f"{f}{r}{t}{q}": (ord(f) * ord(t) + int(r) * int(q)) % 97 for f in "abcdefgh" for r in "2457" for t in "abcdefgh" for q in "36"})
+    samples = (("vote", "vote 3 e2e4"), ("fen", FEN_PREFIX + "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"),
+               ("pgn", pgn), ("analysis", analysis), ("tally", tally))
+
+    for name, msg in samples:
+        raw = len(encode_frame(msg, FRAMING_COMPACT)[1])
+        start = time.perf_counter()
+        for _ in range(repeat):
+            bheader, bmsg = encode_frame(msg, FRAMING_COMPACT_ZLIB)
+        encode_time = (time.perf_counter() - start) / repeat
+        _, compressed = decode_header(bheader, FRAMING_COMPACT_ZLIB)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decode_body(bmsg, compressed)
+        decode_time = (time.perf_counter() - start) / repeat
+        print(f"{name:>8}: {raw:6} -> {len(bmsg):6} bytes ({100 * (1 - len(bmsg) / raw):5.1f}% saved), "
+              f"encode {encode_time * 1e6:7.1f} us, decode {decode_time * 1e6:7.1f} us")
+
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    benchmark_framing()
+    benchmark_compression()
\ No newline at end of file